@@ -0,0 +1,212 @@
+# Lazy, memory-mapped GLB assets, and decimated levels of detail of them cached on disk
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+from functools import cache
+from typing import Iterator, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+assets_dir = os.path.join(os.path.dirname(__file__), '..', 'assets')
+lod_cache_dir = os.getenv('ASSET_CACHE_DIR', os.path.join(os.path.dirname(__file__), '..', '.cache', 'assets'))
+
+_glb_magic, _json_chunk, _bin_chunk = 0x46546C67, 0x4E4F534A, 0x004E4942
+_component_dtypes = {5120: np.int8, 5121: np.uint8, 5122: np.int16, 5123: np.uint16, 5125: np.uint32,
+                     5126: np.float32}
+_type_sizes = {'SCALAR': 1, 'VEC2': 2, 'VEC3': 3, 'VEC4': 4, 'MAT4': 16}
+
+
+class Asset:
+    """A GLB file that is only opened (memory-mapped, so only the pages that are read get loaded) when first used"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._map: Optional[mmap.mmap] = None
+
+    @property
+    def map(self) -> mmap.mmap:
+        if self._map is None:
+            with open(self.path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._map[:4] != b'glTF':
+                raise ValueError(f"{self.path} is not a GLB file" + (
+                    " but a Git LFS pointer, fetch it with `git lfs pull`"
+                    if self._map[:64].startswith(b'version https://git-lfs') else ""))
+        return self._map
+
+    def data(self) -> bytes:
+        """The whole file, as required by the viewer"""
+        return self.map[:]
+
+    def digest(self) -> str:
+        return hashlib.sha256(self.map).hexdigest()
+
+    def meshes(self) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        """The vertices (n x 3, in scene coordinates) and triangles (m x 3) of each triangle primitive of the scene.
+        Vertex data is read directly from the mapped file."""
+        gltf, binary = _read_glb(self.map)
+
+        def accessor(index: int) -> np.ndarray:
+            acc = gltf['accessors'][index]
+            if 'sparse' in acc or 'bufferView' not in acc:
+                raise ValueError(f"Unsupported sparse or empty accessor in {self.path}")
+            view = gltf['bufferViews'][acc['bufferView']]
+            if view.get('buffer', 0) != 0:
+                raise ValueError(f"Unsupported external buffer in {self.path}")
+            dtype, size = np.dtype(_component_dtypes[acc['componentType']]), _type_sizes[acc['type']]
+            stride = view.get('byteStride') or dtype.itemsize * size
+            offset = view.get('byteOffset', 0) + acc.get('byteOffset', 0)
+            return np.ndarray((acc['count'], size), dtype=dtype, buffer=binary, offset=offset,
+                              strides=(stride, dtype.itemsize))
+
+        if unsupported := set(gltf.get('extensionsRequired', [])):
+            raise ValueError(f"Unsupported GLB extensions {', '.join(sorted(unsupported))} in {self.path}")
+        scene = gltf.get('scenes', [{'nodes': range(len(gltf.get('nodes', [])))}])[gltf.get('scene', 0)]
+        pending = [(node, np.eye(4)) for node in scene['nodes']]
+        while pending:
+            node_index, parent_matrix = pending.pop()
+            node = gltf['nodes'][node_index]
+            matrix = parent_matrix @ _node_matrix(node)
+            pending.extend((child, matrix) for child in node.get('children', []))
+            if 'mesh' not in node:
+                continue
+            for primitive in gltf['meshes'][node['mesh']]['primitives']:
+                if primitive.get('mode', 4) != 4:
+                    continue  # Only triangles (not points, lines or strips)
+                positions = accessor(primitive['attributes']['POSITION']).astype(np.float64)
+                vertices = positions @ matrix[:3, :3].T + matrix[:3, 3]
+                if 'indices' in primitive:
+                    triangles = accessor(primitive['indices']).reshape(-1, 3).astype(np.int64)
+                else:
+                    triangles = np.arange(len(vertices)).reshape(-1, 3)
+                yield vertices, triangles
+
+
+def _read_glb(data: mmap.mmap) -> tuple[dict, memoryview]:
+    magic, version, length = struct.unpack_from('<III', data, 0)
+    if magic != _glb_magic or version != 2:
+        raise ValueError("Only binary glTF 2.0 (GLB) files are supported")
+    gltf, binary, offset = None, memoryview(b''), 12
+    while offset < length:
+        chunk_length, chunk_type = struct.unpack_from('<II', data, offset)
+        if chunk_type == _json_chunk:
+            gltf = json.loads(data[offset + 8:offset + 8 + chunk_length])
+        elif chunk_type == _bin_chunk:
+            binary = memoryview(data)[offset + 8:offset + 8 + chunk_length]
+        offset += 8 + chunk_length
+    if gltf is None:
+        raise ValueError("GLB file without JSON chunk")
+    return gltf, binary
+
+
+def _node_matrix(node: dict) -> np.ndarray:
+    if 'matrix' in node:
+        return np.array(node['matrix'], dtype=np.float64).reshape(4, 4).T  # Column-major
+    x, y, z, w = node.get('rotation', (0, 0, 0, 1))
+    rotation = np.array([[1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+                         [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+                         [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)]])
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotation * np.array(node.get('scale', (1, 1, 1)))
+    matrix[:3, 3] = node.get('translation', (0, 0, 0))
+    return matrix
+
+
+# ================== LEVELS OF DETAIL ==================
+
+
+def _cluster(vertices: np.ndarray, triangles: np.ndarray, resolution: int) -> tuple[np.ndarray, np.ndarray]:
+    """Vertex clustering: merge the vertices in each cell of a grid, and drop the triangles that collapse"""
+    low, size = vertices.min(axis=0), np.ptp(vertices, axis=0)
+    cell = max(size.max(), 1e-12) / resolution
+    cells = np.floor((vertices - low) / cell).astype(np.int64)
+    _, inverse, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    merged = np.zeros((len(counts), 3))
+    np.add.at(merged, inverse, vertices)
+    merged /= counts[:, None]
+    triangles = inverse[triangles]
+    triangles = triangles[(triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) &
+                          (triangles[:, 2] != triangles[:, 0])]
+    # Triangles collapsed onto the same vertices (in any winding) are duplicates
+    _, unique = np.unique(np.sort(triangles, axis=1), axis=0, return_index=True)
+    triangles = triangles[np.sort(unique)]
+    used, triangles = np.unique(triangles, return_inverse=True)
+    return merged[used], triangles.reshape(-1, 3)
+
+
+def decimate(vertices: np.ndarray, triangles: np.ndarray, max_triangles: int) -> tuple[np.ndarray, np.ndarray]:
+    """A simplified mesh with at most max_triangles, using the finest vertex clustering grid that fits the budget"""
+    if len(triangles) <= max_triangles:
+        return vertices, triangles
+    best, low, high = None, 1, 4096
+    while low <= high:  # Binary search of the grid resolution, as finer grids keep more triangles
+        resolution = (low + high) // 2
+        candidate = _cluster(vertices, triangles, resolution)
+        if len(candidate[1]) <= max_triangles:
+            best, low = candidate, resolution + 1
+        else:
+            high = resolution - 1
+    return best if best is not None else _cluster(vertices, triangles, 1)
+
+
+def write_glb(path: str, vertices: np.ndarray, triangles: np.ndarray, color=(0.8, 0.8, 0.8, 1.0)):
+    """A single untextured mesh as a GLB file"""
+    positions = vertices.astype(np.float32).tobytes()
+    indices = triangles.astype(np.uint32).tobytes()
+    binary = positions + indices
+    gltf = {
+        'asset': {'version': '2.0', 'generator': 'src.assets'},
+        'scene': 0, 'scenes': [{'nodes': [0]}], 'nodes': [{'mesh': 0}],
+        'meshes': [{'primitives': [{'attributes': {'POSITION': 0}, 'indices': 1, 'material': 0}]}],
+        'materials': [{'pbrMetallicRoughness': {'baseColorFactor': list(color), 'metallicFactor': 0.0}}],
+        'buffers': [{'byteLength': len(binary)}],
+        'bufferViews': [{'buffer': 0, 'byteOffset': 0, 'byteLength': len(positions), 'target': 34962},
+                        {'buffer': 0, 'byteOffset': len(positions), 'byteLength': len(indices), 'target': 34963}],
+        'accessors': [{'bufferView': 0, 'componentType': 5126, 'count': len(vertices), 'type': 'VEC3',
+                       'min': vertices.min(axis=0).tolist(), 'max': vertices.max(axis=0).tolist()},
+                      {'bufferView': 1, 'componentType': 5125, 'count': triangles.size, 'type': 'SCALAR'}],
+    }
+    json_chunk = json.dumps(gltf, separators=(',', ':')).encode()
+    json_chunk += b' ' * (-len(json_chunk) % 4)
+    binary += b'\0' * (-len(binary) % 4)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack('<III', _glb_magic, 2, 12 + 8 + len(json_chunk) + 8 + len(binary)))
+        f.write(struct.pack('<II', len(json_chunk), _json_chunk) + json_chunk)
+        f.write(struct.pack('<II', len(binary), _bin_chunk) + binary)
+    os.replace(tmp_path, path)  # Atomic, so concurrent builds never read partial files
+
+
+# ================== LOADING ==================
+
+
+@cache
+def asset(name: str) -> Asset:
+    """The GLB asset of that name, which is not read until used"""
+    return Asset(os.path.join(assets_dir, name + '.glb'))
+
+
+def lod(name: str, max_triangles: int) -> Asset:
+    """A decimated version of the asset with at most max_triangles, built once and cached until the asset changes"""
+    source = asset(name)
+    path = os.path.join(lod_cache_dir, f'{name}-{max_triangles}-{source.digest()[:16]}.glb')
+    if not os.path.exists(path):
+        logger.info("Decimating %s to %d triangles", name, max_triangles)
+        meshes = list(source.meshes())
+        if not meshes:
+            raise ValueError(f"{source.path} has no triangle meshes to decimate")
+        offsets = np.cumsum([0] + [len(vertices) for vertices, _ in meshes[:-1]])
+        vertices, triangles = decimate(np.concatenate([vertices for vertices, _ in meshes]),
+                                       np.concatenate([t + o for (_, t), o in zip(meshes, offsets)]), max_triangles)
+        os.makedirs(lod_cache_dir, exist_ok=True)
+        for entry in os.scandir(lod_cache_dir):  # Of previous versions of the asset
+            if entry.name.startswith(f'{name}-{max_triangles}-') and entry.name.endswith('.glb'):
+                os.remove(entry.path)
+        write_glb(path, vertices, triangles)
+    return Asset(path)
@@ -0,0 +1,298 @@
+# Benchmarks of the modelling pipeline, with a JSON history, scaling curves and regression checks against a baseline:
+# `python -m src.bench [case or group ...] [--plot scaling.png] [--save-baseline]`
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from importlib.metadata import version
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+bench_dir = os.path.join(os.path.dirname(__file__), '..', 'benchmarks')
+grid_sizes = (2, 4, 8, 16)  # Holes per side of the square (rounded) grids
+stack_layers = (1, 2, 4, 8)
+rss_noise = 4 * 2 ** 20  # Bytes of peak rss increase that are not a regression, whatever the threshold
+
+
+@dataclass(frozen=True)
+class Case:
+    name: str
+    group: str  # The cases of a group with a size are plotted as a scaling curve
+    size: Optional[int]  # Grid cells, or stacked layers
+    prepare: Callable[[], Callable[[], object]]  # Imports and builds the inputs (untimed), returning the timed build
+
+
+@dataclass
+class CaseResult:
+    name: str
+    group: str
+    size: Optional[int]
+    seconds: float  # Fastest of the repetitions
+    median_seconds: float
+    peak_rss: int  # Bytes, of the whole worker process
+    peak_rss_increase: int  # Bytes, over the worker after importing and preparing
+
+
+cases: dict[str, Case] = {}
+
+
+def case(name: str, group: str = None, size: Optional[int] = None):
+    """Register a benchmark case"""
+
+    def register(prepare: Callable[[], Callable[[], object]]):
+        cases[name] = Case(name, group or name, size, prepare)
+        return prepare
+
+    return register
+
+
+@case('screwable_cylinder')
+def _screwable_cylinder():
+    from src.screwable_cylinder import ScrewableCylinder
+    return lambda: ScrewableCylinder(rotation=(0, 0, 90))
+
+
+def _grid(grid_class: str, n: int):
+    from src import conn_grid
+    from src.conn_grid import Grid2D
+    kwargs = {'wrapped_screw_length': 8} if grid_class == 'GridScrewThreadHoles' else {}
+    return lambda: getattr(conn_grid, grid_class)(repeat=Grid2D(n, n), **kwargs)
+
+
+def _grid_stack(layers: int):
+    from src.conn_grid import (Grid2D, GridNutHolesLayer, GridScrewHeadHolesLayer, GridScrewThreadHolesLayer,
+                               GridStack)
+    layer_types = [lambda: GridNutHolesLayer(repeat=Grid2D(4, 4)),
+                   lambda: GridScrewThreadHolesLayer(repeat=Grid2D(4, 4), wrapped_screw_length=8),
+                   lambda: GridScrewHeadHolesLayer(repeat=Grid2D(4, 4))]
+    return lambda: GridStack(layers=[layer_types[i % len(layer_types)]() for i in range(layers)])
+
+
+for _class, _group in (('GridNutHoles', 'grid_nut_holes'), ('GridScrewHeadHoles', 'grid_screw_head_holes'),
+                       ('GridScrewThreadHoles', 'grid_screw_thread_holes')):
+    for _n in grid_sizes:
+        case(f'{_group}_{_n}x{_n}', _group, _n * _n)(lambda c=_class, n=_n: _grid(c, n))
+for _layers in stack_layers:
+    case(f'grid_stack_{_layers}', 'grid_stack', _layers)(lambda layers=_layers: _grid_stack(layers))
+
+
+@case('build_core')
+def _build_core():
+    from src.core import build_core
+    return build_core
+
+
+@case('module_allen_box')
+def _module_allen_box():
+    from src.module_allen_box import build_conn_grid, build_module_allen_box
+    conn_grid = build_conn_grid()
+    return lambda: build_module_allen_box(conn_grid=conn_grid)
+
+
+@case('module_allen_box_lid')
+def _module_allen_box_lid():
+    from src.module_allen_box import build_lid
+    return build_lid
+
+
+# ================== RUNNING ==================
+
+
+def _peak_rss() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _run_case(name: str, repeat: int) -> CaseResult:
+    """Worker entry point: each case runs in a fresh process, so that imports, in-process caches and peak memory
+    are not shared with other cases"""
+    c = cases[name]
+    build = c.prepare()
+    rss_before = _peak_rss()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        build()
+        times.append(time.perf_counter() - start)
+    peak_rss = _peak_rss()
+    return CaseResult(name, c.group, c.size, min(times), statistics.median(times), peak_rss, peak_rss - rss_before)
+
+
+def run(names: list[str], repeat: int = 3) -> tuple[list[CaseResult], list[str]]:
+    """Run the cases sequentially (so that they don't compete for the CPU), without the on-disk part cache.
+    Returns the results and the names of the failed cases."""
+    os.environ['BUILD_CACHE_DISABLE'] = '1'  # Inherited by the spawned workers
+    results, failed = [], []
+    for name in names:
+        try:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                result = pool.submit(_run_case, name, repeat).result()
+        except Exception:
+            logger.exception("Failed benchmarking %s", name)
+            failed.append(name)
+            continue
+        logger.info("%s: %.3f seconds (median %.3f), peak rss %.1f MiB (+%.1f MiB)", name, result.seconds,
+                    result.median_seconds, result.peak_rss / 2 ** 20, result.peak_rss_increase / 2 ** 20)
+        results.append(result)
+    return results, failed
+
+
+def environment() -> dict:
+    """What the results depend on, besides the code"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'versions': {package: version(package) for package in ('build123d', 'cadquery-ocp')},
+        'python': platform.python_version(),
+        'machine': f'{platform.system()} {platform.machine()} ({os.cpu_count()} CPUs)',
+        'build_mode': os.getenv('BUILD_MODE', 'final'),
+    }
+
+
+# ================== HISTORY ==================
+
+
+def load_json(path: str, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def save_json(path: str, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def regressions(run_record: dict, baseline: dict, threshold: float) -> list[str]:
+    """The cases that got slower or used more memory than the baseline by more than the threshold (a fraction).
+    Memory is the increase of the peak rss during the case, as the imports alone take most of the worker's."""
+    baseline_results = {r['name']: r for r in baseline.get('results', [])}
+    found = []
+    for result in run_record['results']:
+        if (base := baseline_results.get(result['name'])) is None:
+            continue
+        for metric, unit, scale, noise in (('seconds', 's', 1, 0), ('peak_rss_increase', 'MiB', 2 ** 20, rss_noise)):
+            if metric in base and result[metric] > base[metric] * (1 + threshold) + noise:
+                change = f"{(result[metric] / base[metric] - 1) * 100:+.0f}%" if base[metric] > 0 else 'new'
+                found.append(f"{result['name']}: {metric} {base[metric] / scale:.3f} -> {result[metric] / scale:.3f}"
+                             f" {unit} ({change})")
+    return found
+
+
+def summary(results: list[dict], baseline: dict) -> str:
+    baseline_results = {r['name']: r for r in baseline.get('results', [])}
+    rows = [('case', 'seconds', 'median', 'peak rss (MiB)', 'rss increase (MiB)', 'vs baseline')]
+    for r in results:
+        base = baseline_results.get(r['name'])
+        rows.append((r['name'], f"{r['seconds']:.3f}", f"{r['median_seconds']:.3f}", f"{r['peak_rss'] / 2 ** 20:.1f}",
+                     f"{r['peak_rss_increase'] / 2 ** 20:.1f}",
+                     f"{(r['seconds'] / base['seconds'] - 1) * 100:+.0f}%" if base and base['seconds'] > 0 else ''))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows)
+
+
+def plot(results: list[dict], path: str, baseline: dict = None):
+    """Time and peak memory increase against the size of each group of cases, with the baseline dashed"""
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        logger.error("Plotting requires matplotlib (`pip install matplotlib`), skipping %s", path)
+        return
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+    for records, style in ((baseline.get('results', []) if baseline else [], '--'), (results, '-o')):
+        groups: dict[str, list[dict]] = {}
+        for r in records:
+            if r['size'] is not None:
+                groups.setdefault(r['group'], []).append(r)
+        for i, (group, group_results) in enumerate(sorted(groups.items())):
+            group_results.sort(key=lambda r: r['size'])
+            sizes = [r['size'] for r in group_results]
+            color = f'C{i}'
+            axes[0].plot(sizes, [r['seconds'] for r in group_results], style, color=color,
+                         label=group if style != '--' else None)
+            axes[1].plot(sizes, [r['peak_rss_increase'] / 2 ** 20 for r in group_results], style, color=color)
+    for ax, label in zip(axes, ('seconds', 'peak rss increase (MiB)')):
+        ax.set_xscale('log', base=2)
+        ax.set_xlabel('size (grid cells or layers)')
+        ax.set_ylabel(label)
+        ax.grid(True, which='both', alpha=0.3)
+    axes[0].set_yscale('log')
+    axes[0].legend()
+    fig.suptitle('Scaling (dashed: baseline)' if baseline else 'Scaling')
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+    logger.info("Wrote scaling curves to %s", path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the modelling pipeline and check for regressions")
+    parser.add_argument('cases', nargs='*', help="cases or groups of cases to run (default: all, see --list)")
+    parser.add_argument('--list', action='store_true', help="list the cases and exit")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="repetitions of each case (the fastest counts)")
+    parser.add_argument('--history', default=os.path.join(bench_dir, 'history.json'),
+                        help="JSON file that each run is appended to")
+    parser.add_argument('--baseline', default=os.path.join(bench_dir, 'baseline.json'),
+                        help="JSON file of the run to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="make this run the new baseline")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="slowdown or memory increase over the baseline flagged as a regression (fraction)")
+    parser.add_argument('--plot', metavar='PNG', help="plot the scaling curves to this file (requires matplotlib)")
+    parser.add_argument('--draft', action='store_true', help="benchmark the draft build mode")
+    args = parser.parse_args()
+
+    if args.list:
+        for c in cases.values():
+            print(f'{c.name}  (group {c.group}' + (f', size {c.size})' if c.size is not None else ')'))
+        sys.exit(0)
+    selected = [name for name, c in cases.items() if not args.cases or name in args.cases or c.group in args.cases]
+    if unknown := set(args.cases) - set(cases) - {c.group for c in cases.values()}:
+        parser.error(f"unknown cases: {', '.join(sorted(unknown))}")
+    if args.draft:
+        os.environ['BUILD_MODE'] = 'draft'  # Inherited by the workers
+
+    logging.basicConfig(level=logging.INFO)
+    results, failed = run(selected, args.repeat)
+    record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'environment': environment(),
+              'results': [asdict(result) for result in results], 'failed': failed}
+    history = load_json(args.history, [])
+    history.append(record)
+    save_json(args.history, history)
+    baseline = load_json(args.baseline, {})
+    if baseline and baseline.get('environment', {}).get('machine') != record['environment']['machine']:
+        logger.warning("The baseline was recorded on another machine (%s), comparisons may not be meaningful",
+                       baseline['environment'].get('machine'))
+    logger.info("Results (history in %s):\n%s", args.history, summary(record['results'], baseline))
+    if args.plot:
+        plot(record['results'], args.plot, baseline)
+    found = regressions(record, baseline, args.threshold) if baseline else []
+    if args.save_baseline:
+        save_json(args.baseline, record)
+        logger.info("Saved the new baseline to %s", args.baseline)
+    if found:
+        logger.error("Regressions over %.0f%% against the baseline of %s:\n%s", args.threshold * 100,
+                     baseline.get('time'), '\n'.join(found))
+        if baseline.get('environment', {}).get('versions') != record['environment']['versions']:
+            logger.error("Versions changed: %s -> %s", baseline['environment'].get('versions'),
+                         record['environment']['versions'])
+    sys.exit(1 if found or failed else 0)
@@ -0,0 +1,232 @@
+# Build all (or some) targets in parallel and export them: `python -m src.build [target ...]`
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Callable
+
+import build123d as bd
+
+from src.cache import shape_from_brep, shape_to_brep
+from src.manifest import Manifest, fingerprint, signature
+from src.mesh_export import default_lods, export_meshes, formats as mesh_formats
+from src.global_params import set_build_mode, viewer_options
+from src.validation import levels, set_level
+from src import profiling, viewer
+
+logger = logging.getLogger(__name__)
+
+
+# ================== TARGETS ==================
+
+
+@dataclass(frozen=True)
+class Target:
+    name: str
+    build: Callable[..., bd.Shape]  # Receives the built dependencies as keyword arguments
+    deps: tuple[str, ...] = ()
+    export: bool = True
+
+
+targets: dict[str, Target] = {}
+
+
+def target(name: str, deps: tuple[str, ...] = (), export: bool = True):
+    """Register a buildable target. Modules are imported lazily by the build functions."""
+
+    def register(build: Callable[..., bd.Shape]):
+        targets[name] = Target(name, build, deps, export)
+        return build
+
+    return register
+
+
+@target('screwable_cylinder', export=False)
+def _build_screwable_cylinder():
+    from src.screwable_cylinder import ScrewableCylinder
+    return ScrewableCylinder(rotation=(0, 0, 90))
+
+
+@target('conn_grid', export=False)
+def _build_conn_grid():
+    from src.module_allen_box import build_conn_grid
+    return build_conn_grid()
+
+
+@target('core')
+def _build_core():
+    from src.core import build_core
+    return build_core()
+
+
+@target('module_allen_box', deps=('conn_grid',))
+def _build_module_allen_box(conn_grid: bd.Part):
+    from src.module_allen_box import build_module_allen_box
+    return build_module_allen_box(conn_grid=conn_grid)
+
+
+@target('module_allen_box_lid')
+def _build_module_allen_box_lid():
+    from src.module_allen_box import build_lid
+    return build_lid()
+
+
+# ================== SCHEDULING ==================
+
+
+def _build_target(name: str, deps: dict[str, bytes]) -> tuple[bytes, float]:
+    """Worker entry point: results are passed between processes as serialized BREPs"""
+    start = time.time()
+    try:
+        shape = targets[name].build(**{dep: shape_from_brep(data) for dep, data in deps.items()})
+    finally:
+        profiling.flush()
+    return shape_to_brep(shape), time.time() - start
+
+
+def resolve(names: list[str]) -> list[str]:
+    """The requested targets and all their (transitive) dependencies, dependencies first"""
+    resolved = []
+
+    def visit(name: str):
+        if name not in targets:
+            raise ValueError(f"Unknown target {name!r}, available: {', '.join(targets)}")
+        if name not in resolved:
+            for dep in targets[name].deps:
+                visit(dep)
+            resolved.append(name)
+
+    for name in names:
+        visit(name)
+    return resolved
+
+
+def build(names: list[str], jobs: int = None) -> dict[str, bytes]:
+    """Build the targets (and their dependencies) concurrently, returning their serialized BREPs.
+    Targets that fail (or depend on failed targets) are logged and missing from the result."""
+    pending = resolve(names)
+    built: dict[str, bytes] = {}
+    failed: set[str] = set()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        running: dict[Future, str] = {}
+        while pending or running:
+            for name in list(pending):
+                if any(dep in failed for dep in targets[name].deps):
+                    logger.error("Skipping %s, as some of its dependencies failed", name)
+                    pending.remove(name)
+                    failed.add(name)
+                elif all(dep in built for dep in targets[name].deps):
+                    pending.remove(name)
+                    try:
+                        running[pool.submit(_build_target, name,
+                                            {dep: built[dep] for dep in targets[name].deps})] = name
+                    except BrokenProcessPool:  # A worker died (e.g. a crash in OCCT), so nothing else can run
+                        logger.error("Failed building %s, as a build process crashed", name)
+                        failed.add(name)
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    built[name], elapsed = future.result()
+                    logger.info("Built %s in %.2f seconds", name, elapsed)
+                except Exception:
+                    logger.exception("Failed building %s", name)
+                    failed.add(name)
+    return built
+
+
+def _export_glb(name: str, data: bytes, folder: str, options: dict) -> float:
+    """Worker entry point: tessellates a target with the viewer of the worker (without server) and exports it"""
+    os.environ.setdefault('YACV_DISABLE_SERVER', 'True')  # Only used for its exporter
+
+    start = time.time()
+    viewer.show(shape_from_brep(data), names=[name], **options)
+    viewer.export_all(folder, export_filter=lambda shown_name, obj: shown_name == name)
+    return time.time() - start
+
+
+def export(built: dict[str, bytes], folder: str, jobs: int = None, deflection: tuple[float, float] = None,
+           meshes: tuple[str, ...] = (), force: bool = False):
+    """Export the built targets in parallel to GLB files, in the same format as the viewer, tessellated with the
+    (linear, angular) deflection if given. Also export levels of detail of meshes in the given formats.
+
+    Targets whose geometry and export options match the manifest of the folder are skipped, unless forced.
+    In headless mode, GLBs (which are made by the viewer) are not exported."""
+    options = viewer_options()
+    if deflection is not None:
+        options.update(tolerance=deflection[0], angular_tolerance=deflection[1])
+    params = {'glb': None if viewer.headless else options, 'meshes': sorted(meshes),
+              'lods': default_lods if meshes else []}
+    manifest = Manifest(folder)
+    signatures, fingerprints, pending = {}, {}, {}
+    for name, data in built.items():
+        signatures[name] = signature(shape_from_brep(data), data)
+        fingerprints[name] = fingerprint(params, signatures[name])
+        if not force and manifest.is_current(name, fingerprints[name]):
+            logger.info("Skipping export of %s, unchanged since the last one", name)
+        else:
+            pending[name] = data
+
+    files = {name: [] if viewer.headless else [os.path.join(folder, f'{name}.glb')] for name in pending}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {name: pool.submit(_export_glb, name, data, folder, options) for name, data in pending.items()
+                   if not viewer.headless}
+        for name, future in futures.items():
+            elapsed = future.result()
+            logger.info("Exported %s.glb (%.1f KiB) in %.2f seconds", name,
+                        os.path.getsize(os.path.join(folder, f'{name}.glb')) / 1024, elapsed)
+    if meshes and pending:
+        for report in export_meshes(pending, folder, meshes, jobs=jobs):
+            files[report.part].append(report.path)
+    for name in pending:
+        manifest.update(name, fingerprints[name], params, signatures[name], files[name])
+    manifest.save()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build targets in parallel and export them")
+    parser.add_argument('targets', nargs='*', help=f"targets to build and export (default: all exported ones): "
+                                                   f"{', '.join(targets)}")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('-o', '--output', default=os.path.join(os.path.dirname(__file__), '..', 'export'),
+                        help="export folder")
+    parser.add_argument('--no-export', action='store_true', help="only build the targets")
+    parser.add_argument('--deflection', type=float, nargs=2, metavar=('LINEAR', 'ANGULAR'),
+                        help="tessellation of the exported GLBs, in mm and radians (default: as in the viewer)")
+    parser.add_argument('--mesh', action='append', choices=mesh_formats, default=[],
+                        help="also export full and low-poly meshes in this format, may be repeated")
+    parser.add_argument('--force', action='store_true', help="export even the targets that did not change")
+    parser.add_argument('--draft', action='store_true',
+                        help="fast preview build, without cosmetic fillets/chamfers (not for printing)")
+    parser.add_argument('--validate', choices=levels, default=None,
+                        help="validity checks to run (default: BUILD_VALIDATE or final)")
+    parser.add_argument('--headless', action='store_true',
+                        help="never load the viewer (also BUILD_HEADLESS): export meshes (stl by default), not GLBs")
+    args = parser.parse_args()
+    if unknown := set(args.targets) - set(targets):
+        parser.error(f"unknown targets: {', '.join(sorted(unknown))}")
+    if args.draft:
+        set_build_mode('draft')  # Before starting the workers, which inherit it
+    if args.validate:
+        set_level(args.validate)
+    if args.headless:
+        viewer.set_headless()
+    if viewer.headless and not args.mesh:
+        args.mesh = ['stl']
+
+    logging.basicConfig(level=logging.INFO)
+    start = time.time()
+    requested = args.targets or [name for name, t in targets.items() if t.export]
+    built = build(requested, args.jobs)
+    if not args.no_export:
+        export({name: data for name, data in built.items() if name in requested}, args.output, args.jobs,
+               args.deflection, tuple(args.mesh), args.force)
+    total = len(resolve(requested))
+    logger.info("Built %d/%d targets in %.2f seconds", len(built), total, time.time() - start)
+    sys.exit(0 if len(built) == total else 1)
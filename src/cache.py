@@ -0,0 +1,266 @@
+import ast
+import enum
+import hashlib
+import inspect
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import textwrap
+from dataclasses import fields, is_dataclass
+from functools import cache
+from typing import Callable, Optional
+
+import OCP
+import build123d as bd
+from OCP.BinTools import BinTools
+from OCP.Standard import Standard_Failure
+from OCP.TopoDS import TopoDS_Shape
+
+from src import global_params
+from src.global_params import wall, tol
+
+logger = logging.getLogger(__name__)
+
+# Content-addressed on-disk cache of built shapes, stored as binary BREP and evicted in LRU order
+cache_dir = os.getenv('BUILD_CACHE_DIR', os.path.join(os.path.dirname(__file__), '..', '.cache', 'brep'))
+cache_max_size = int(float(os.getenv('BUILD_CACHE_MAX_MB', '512')) * 1024 * 1024)
+cache_enabled = os.getenv('BUILD_CACHE_DISABLE', '') == ''
+
+# Fields of BasePartObject subclasses that only place the built part, so they don't affect the cached geometry
+_placement_fields = {'rotation', 'align', 'mode'}
+
+
+# ================== SERIALIZATION ==================
+
+def write_brep(shape: bd.Shape, path: str):
+    BinTools.Write_s(shape.wrapped, path)
+
+
+def read_brep(path: str) -> bd.Shape:
+    shape = TopoDS_Shape()
+    BinTools.Read_s(shape, path)  # NOTE: reading from python streams is broken for binary BREPs, so use files
+    if shape.IsNull():
+        raise ValueError(f"Could not read BREP from {path}")
+    shape = bd.Shape.cast(shape)
+    return bd.Part(shape.wrapped) if isinstance(shape, bd.Compound) else shape
+
+
+def shape_to_brep(shape: bd.Shape) -> bytes:
+    buf = io.BytesIO()
+    BinTools.Write_s(shape.wrapped, buf)
+    return buf.getvalue()
+
+
+def shape_from_brep(data: bytes) -> bd.Shape:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'shape.brep')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return read_brep(path)
+
+
+# ================== KEYS ==================
+
+def _is_main_block(node: ast.stmt) -> bool:
+    """Whether a statement is `if __name__ == "__main__":`, which does not run when the module is imported"""
+    return isinstance(node, ast.If) and isinstance(node.test, ast.Compare) and \
+        isinstance(node.test.left, ast.Name) and node.test.left.id == '__name__'
+
+
+def module_dependencies(module_name: str) -> set[str]:
+    """The src modules that a loaded src module imports (also inside functions), found in its source.
+
+    Its imports, unlike its globals, include the plain values that it imports from other modules."""
+    module = sys.modules.get(module_name)
+    if module is None or not getattr(module, '__file__', None):
+        return set()
+    with open(module.__file__, 'rb') as f:
+        tree = ast.parse(f.read(), module.__file__)
+    deps = set()
+    pending = [node for node in tree.body if not _is_main_block(node)]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, ast.Import):
+            deps.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            deps.add(node.module)
+            # `from src import x` imports the module src.x
+            deps.update(f'{node.module}.{alias.name}' for alias in node.names
+                        if f'{node.module}.{alias.name}' in sys.modules)
+        pending.extend(ast.iter_child_nodes(node))
+    return {dep for dep in deps if dep.startswith('src.') and dep != module_name}
+
+
+@cache
+def _source_digest(module_name: str) -> str:
+    """Hash of the source of a src module and of every src module it (transitively) uses."""
+    seen, pending, digest = set(), [module_name], hashlib.sha256()
+    while pending:
+        name = pending.pop()
+        module = sys.modules.get(name)
+        if name in seen or module is None or not hasattr(module, '__file__'):
+            continue
+        seen.add(name)
+        with open(module.__file__, 'rb') as f:
+            digest.update(os.path.basename(module.__file__).encode() + b'\0' + f.read())
+        pending.extend(sorted(module_dependencies(name) - {__name__}))  # Deterministic, unlike sets
+    return digest.hexdigest()
+
+
+def _global_names(obj) -> set[str]:
+    """The names that the source of a function or class reads, which may refer to module globals"""
+    tree = ast.parse(textwrap.dedent(inspect.getsource(obj)))
+    return {node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)}
+
+
+def _is_data(value) -> bool:
+    """Whether a global is a plain value, whose repr is stable across processes (unlike `<object at 0x...>`)"""
+    return isinstance(value, (int, float, str, bytes, type(None), tuple, list, dict, set, frozenset, enum.Enum)) \
+        or (is_dataclass(value) and not isinstance(value, type))
+
+
+@cache
+def _function_digest(func: Callable) -> str:
+    """Hash of the source of a build function, of the functions and classes of its module that it (transitively)
+    uses, and of the values of the globals they read. Other src modules that they use count as a whole, and library
+    code as its version (see `cache_key`), so editing a module only changes the digests of the functions that use
+    the edited parts of it."""
+    module = sys.modules[func.__module__]
+    seen, pending, digest = set(), [func], hashlib.sha256()
+    while pending:
+        obj = pending.pop()
+        if obj in seen:
+            continue
+        seen.add(obj)
+        digest.update(inspect.getsource(obj).encode())
+        for name in sorted(_global_names(obj)):  # Deterministic, unlike sets
+            if name not in vars(module):  # Locals and builtins
+                continue
+            value = vars(module)[name]
+            if isinstance(value, type(sys)):
+                if value.__name__.startswith('src.') and value.__name__ != __name__:
+                    digest.update(_source_digest(value.__name__).encode())
+            elif inspect.isfunction(value) or inspect.isclass(value):
+                if value.__module__ == module.__name__:
+                    pending.append(value)
+                elif value.__module__.startswith('src.') and value.__module__ != __name__:
+                    digest.update(_source_digest(value.__module__).encode())
+            elif _is_data(value):
+                digest.update(f'{name}={value!r}'.encode())
+    return digest.hexdigest()
+
+
+def clear_digests():
+    """Forget the source digests, after the sources changed (and their modules were reloaded)"""
+    _source_digest.cache_clear()
+    _function_digest.cache_clear()
+
+
+def cache_key(name: str, params: dict, source: str) -> str:
+    """Content address of a shape: its builder, (global) parameters, build mode, source code (digest) and CAD kernel."""
+    return hashlib.sha256(json.dumps({
+        'name': name,
+        'params': params,
+        'global_params': {'wall': wall, 'tol': tol},
+        'build_mode': global_params.build_mode,  # Draft builds must never be reused for final ones
+        'versions': {'build123d': bd.__version__, 'OCP': OCP.__version__},
+        'source': source,
+    }, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+def part_params(obj) -> dict:
+    """Parameters of a dataclass part object that affect its geometry."""
+    return {f.name: getattr(obj, f.name) for f in fields(obj) if f.name not in _placement_fields}
+
+
+# ================== STORAGE ==================
+
+def _evict():
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.brep'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= cache_max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:  # Evicted concurrently by another build
+            pass
+        total_size -= size
+        logger.debug("Evicted %s from the BREP cache", os.path.basename(path))
+
+
+def _load(key: str) -> Optional[bd.Shape]:
+    path = os.path.join(cache_dir, key + '.brep')
+    if not os.path.exists(path):
+        return None
+    try:
+        shape = read_brep(path)
+        os.utime(path)  # Mark as recently used
+        return shape
+    except (FileNotFoundError, ValueError, Standard_Failure):  # Evicted or corrupted entry
+        return None
+
+
+def _store(key: str, shape: bd.Shape):
+    path = os.path.join(cache_dir, key + '.brep')
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    write_brep(shape, tmp_path)
+    os.replace(tmp_path, path)  # Atomic, so concurrent builds never read partial files
+    _evict()
+
+
+def cached(name: str, params: dict, build: Callable[[], bd.Shape], module: Optional[str] = None) -> bd.Shape:
+    """Return the shape built by `build`, reusing a previous build with the same key if available."""
+    if not cache_enabled:
+        return build()
+    key = cache_key(name, params, _source_digest(module or build.__module__))
+    shape = _load(key)
+    if shape is not None:
+        logger.debug("BREP cache hit for %s (%s)", name, key[:12])
+        return shape
+    logger.debug("BREP cache miss for %s (%s)", name, key[:12])
+    shape = build()
+    _store(key, shape)
+    return shape
+
+
+def cached_part(obj, build: Callable[[], bd.Shape]) -> bd.Shape:
+    """Cache the part built by a dataclass part object, keyed on its fields."""
+    return cached(type(obj).__qualname__, part_params(obj), build, module=type(obj).__module__)
+
+
+class Stage:
+    """A checkpointed step of a build, whose output is cached by the parameters it reads and the keys of its inputs.
+
+    Results are lazy: a stage whose checkpoint is still valid is loaded without even looking at its inputs, so a
+    rebuild only runs the stages after the last valid checkpoint."""
+
+    def __init__(self, name: str, params: dict, build: Callable[..., bd.Shape], *inputs: 'Stage'):
+        self.name = name
+        self.params = params
+        self.build = build  # Called with the results of the inputs, in order, and the parameters as keywords
+        self.inputs = inputs
+        # Keyed on the code of its build function, not of its whole module: editing a stage (or a tunable that only
+        # it reads) keeps the checkpoints of the stages before it
+        self.key = cache_key(name, {'params': params, 'inputs': [i.key for i in inputs]}, _function_digest(build))
+        self._result: Optional[bd.Shape] = None
+
+    def result(self) -> bd.Shape:
+        if self._result is None:
+            self._result = _load(self.key) if cache_enabled else None
+            if self._result is not None:
+                logger.debug("Loaded checkpoint of stage %s (%s)", self.name, self.key[:12])
+            else:
+                logger.debug("Running stage %s (%s)", self.name, self.key[:12])
+                self._result = self.build(*[i.result() for i in self.inputs], **self.params)
+                if cache_enabled:
+                    _store(self.key, self._result)
+        return self._result
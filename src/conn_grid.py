@@ -6,10 +6,11 @@ from math import cos, radians
 from typing import NamedTuple, Optional, Union
 
 import build123d as bd
-import yacv_server as yacv
 
-from src.global_params import wall, tol
-from src.screwable_cylinder import ScrewableCylinder
+from src.cache import cached_part
+from src.fasteners import Fastener, M5, located
+from src.global_params import wall, tol, cut_all
+from src.viewer import show_all, export_all
 
 # ================== MODELLING ==================
 
@@ -19,110 +20,228 @@ Grid2D = NamedTuple('Grid2D', [('x', int), ('y', int)])
 
 
 @dataclass(kw_only=True)
-class GridBase(bd.BasePartObject):
+class GridLayer:
+    """The specification of a grid of holes, which is only built when used (e.g. as a layer of a GridStack)"""
     dimensions: Grid2DF = Grid2DF(10, 10)
     repeat: Grid2D
     total_dimensions: Optional[Grid2DF] = None
     rounded: bool = True
-
-    rotation: bd.RotationLike = (0, 0, 0)
-    align: Union[bd.Align, tuple[bd.Align, bd.Align, bd.Align]] = None
-    mode: bd.Mode = bd.Mode.PRIVATE
+    fastener: Fastener = M5
 
     def __post_init__(self):
         self.total_dimensions = self.total_dimensions or Grid2DF(
             self.dimensions.x * self.repeat.x, self.dimensions.y * self.repeat.y)
-        with bd.BuildPart() as part:
-            bd.add(self.build_sketch())
-            bd.extrude(amount=self.sketch_depth)
-        super().__init__(part=part.part, rotation=self.rotation,
-                         align=self.align, mode=self.mode)
 
     def build_sketch(self, *workplanes, inverted: bool = False) -> bd.Sketch:
-        with bd.BuildSketch(*workplanes) as sketch:
-            if not inverted:
-                if self.rounded:
-                    bd.RectangleRounded(self.total_dimensions.x, self.total_dimensions.y,
-                                        (self.dimensions.x + self.dimensions.y) / 2 / 2)
-                else:
-                    bd.Rectangle(self.total_dimensions.x, self.total_dimensions.y)
-            with bd.GridLocations(self.dimensions.x, self.dimensions.y, self.repeat.x, self.repeat.y):
-                self._build_sketch(bd.Mode.SUBTRACT if not inverted else bd.Mode.ADD)
-        return sketch.sketch
+        holes = self.hole_faces()
+        if inverted:
+            sketch = holes[0].fuse(*holes[1:]) if len(holes) > 1 else holes[0]
+        elif self._holes_inside_outline(holes):
+            # Fast path: no boolean needed, the holes are just the inner wires of the outline
+            sketch = bd.Face(self._build_outline().outer_wire(), [hole.outer_wire() for hole in holes])
+        else:  # Cut all holes with a single boolean, merging the outline edges that the cut splits
+            sketch = self._build_outline().cut(*holes).clean()
+        planes = bd.WorkplaneList._convert_to_planes(workplanes) or [bd.Plane.XY]
+        return bd.Sketch(bd.Compound([sketch if plane == bd.Plane.XY else plane.from_local_coords(sketch)
+                                      for plane in planes]).wrapped)
 
     @abstractmethod
-    def _build_sketch(self, mode: bd.Mode):
+    def hole_profile(self) -> bd.Face:
+        """The hole of a single cell, centered at the origin."""
         ...
 
+    @abstractmethod
+    def hole_tool(self) -> bd.Solid:
+        """The hole of a single cell through the layer, from the fastener catalog (built once per process)."""
+        ...
+
+    def hole_locations(self) -> list[bd.Location]:
+        return bd.GridLocations(self.dimensions.x, self.dimensions.y, self.repeat.x, self.repeat.y).local_locations
+
+    def hole_faces(self) -> list[bd.Face]:
+        # Located copies share the geometry of the profile, which is only built once per process
+        profile = self.hole_profile()
+        return [located(profile, loc) for loc in self.hole_locations()]
+
+    def hole_wires(self) -> list[bd.Wire]:
+        """The (possibly merged) holes inside the outline, as the inner wires of the sketch"""
+        return [wire for face in self.build_sketch().faces() for wire in face.inner_wires()]
+
+    @property
+    def _corner_radius(self) -> float:
+        return (self.dimensions.x + self.dimensions.y) / 2 / 2 if self.rounded else 0
+
+    @property
+    def outline_key(self) -> tuple:
+        """Layers with the same key have the same outline"""
+        return self.total_dimensions, self._corner_radius
+
+    def _build_outline(self) -> bd.Face:
+        with bd.BuildSketch(mode=bd.Mode.PRIVATE) as outline:
+            if self.rounded:
+                bd.RectangleRounded(self.total_dimensions.x, self.total_dimensions.y, self._corner_radius)
+            else:
+                bd.Rectangle(self.total_dimensions.x, self.total_dimensions.y)
+        return outline.sketch.face()
+
+    def _holes_inside_outline(self, holes: list[bd.Face]) -> bool:
+        """Conservative check that holes don't touch each other or the (convex) outline, using bounding boxes."""
+        margin = tol / 10
+        half_x, half_y, radius = self.total_dimensions.x / 2, self.total_dimensions.y / 2, self._corner_radius
+        for hole in holes:
+            bb = hole.bounding_box()
+            if bb.size.X + margin >= self.dimensions.x or bb.size.Y + margin >= self.dimensions.y:
+                return False  # Could touch the holes of the neighbouring cells
+            for x in (bb.min.X, bb.max.X):
+                for y in (bb.min.Y, bb.max.Y):
+                    if abs(x) + margin >= half_x or abs(y) + margin >= half_y:
+                        return False
+                    dx, dy = max(abs(x) - (half_x - radius), 0), max(abs(y) - (half_y - radius), 0)
+                    if dx ** 2 + dy ** 2 >= (radius - margin) ** 2 > 0:
+                        return False
+        return True
+
     @property
     def sketch_depth(self):
         return wall
 
 
 @dataclass(kw_only=True)
-class GridNutHoles(GridBase):
-    minor_radius = ScrewableCylinder.nut_inscribed_diameter / 2
-    depth: float = ScrewableCylinder.nut_height
+class GridBase(GridLayer, bd.BasePartObject):
+    """A grid of holes, built (and placed) as a part"""
+    rotation: bd.RotationLike = (0, 0, 0)
+    align: Union[bd.Align, tuple[bd.Align, bd.Align, bd.Align]] = None
+    mode: bd.Mode = bd.Mode.PRIVATE
 
-    def _build_sketch(self, mode: bd.Mode):
-        major_radius = self.minor_radius / cos(radians(360 / 6 / 2))
+    def __post_init__(self):
+        super().__post_init__()
+        # Not super().__init__, which is the dataclass constructor of GridLayer
+        bd.BasePartObject.__init__(self, part=cached_part(self, self._build_part), rotation=self.rotation,
+                                   align=self.align, mode=self.mode)
+
+    def _build_part(self) -> bd.Part:
+        # Private, as this may be called from within the caller's builder context. There is nothing to clean, as
+        # the sketch is either a face with holes as inner wires or an already cleaned boolean.
+        return bd.extrude(self.build_sketch(), amount=self.sketch_depth, clean=False, mode=bd.Mode.PRIVATE)
+
+
+@dataclass(kw_only=True)
+class GridNutHolesLayer(GridLayer):
+    depth: Optional[float] = None  # Defaults to the nut height
+
+    def hole_profile(self) -> bd.Face:
+        major_radius = self.fastener.nut_inscribed_diameter / 2 / cos(radians(360 / 6 / 2))
         assert major_radius + tol < self.dimensions.x / 2
         assert major_radius + tol < self.dimensions.y / 2
-        bd.RegularPolygon(major_radius, 6, mode=mode)
+        return self.fastener.nut_profile()
+
+    def hole_tool(self) -> bd.Solid:
+        self.hole_profile()  # Checks that the nuts fit in their cells
+        return self.fastener.nut_hole(depth=self.sketch_depth, clearance=0)
 
     @property
     def sketch_depth(self):
-        return self.depth + tol
+        return (self.fastener.nut_height if self.depth is None else self.depth) + tol
 
 
 @dataclass(kw_only=True)
-class GridScrewHeadHoles(GridBase):
-    radius = ScrewableCylinder.screw_head_diameter / 2
-    depth: float = ScrewableCylinder.screw_head_height
+class GridScrewHeadHolesLayer(GridLayer):
+    depth: Optional[float] = None  # Defaults to the screw head height
+
+    def hole_profile(self) -> bd.Face:
+        return self.fastener.head_profile()
 
-    def _build_sketch(self, mode: bd.Mode):
-        bd.Circle(self.radius, mode=mode)
+    def hole_tool(self) -> bd.Solid:
+        return self.fastener.head_hole(depth=self.sketch_depth, clearance=0)
 
     @property
     def sketch_depth(self):
-        return self.depth + tol
+        return (self.fastener.screw_head_height if self.depth is None else self.depth) + tol
 
 
 @dataclass(kw_only=True)
-class GridScrewThreadHoles(GridScrewHeadHoles):
-    radius = ScrewableCylinder.screw_diameter / 2
+class GridScrewThreadHolesLayer(GridScrewHeadHolesLayer):
     wrapped_screw_length: float
 
-    def _build_sketch(self, mode: bd.Mode):
-        bd.Circle(self.radius, mode=mode)
+    def hole_profile(self) -> bd.Face:
+        return self.fastener.thread_profile()
+
+    def hole_tool(self) -> bd.Solid:
+        return self.fastener.thread_hole(self.sketch_depth, clearance=0)
 
     @property
     def sketch_depth(self):
         return self.wrapped_screw_length + tol
 
 
+@dataclass(kw_only=True)
+class GridNutHoles(GridNutHolesLayer, GridBase):
+    pass
+
+
+@dataclass(kw_only=True)
+class GridScrewHeadHoles(GridScrewHeadHolesLayer, GridBase):
+    pass
+
+
+@dataclass(kw_only=True)
+class GridScrewThreadHoles(GridScrewThreadHolesLayer, GridScrewHeadHoles):
+    pass
+
+
 @dataclass(kw_only=True)
 class GridStack(bd.BasePartObject):
-    parts: list[bd.BasePartObject]
+    """Grid layers stacked along Z, from the first (at Z=0) to the last. The layers are specifications (GridLayer),
+    only their holes and outlines are built, as part of the stack."""
+    layers: list[GridLayer]
 
     rotation: bd.RotationLike = (0, 0, 0)
     align: Union[bd.Align, tuple[bd.Align, bd.Align, bd.Align]] = None
     mode: bd.Mode = bd.Mode.ADD
 
     def __post_init__(self):
-        offset_z = 0
-        with bd.BuildPart() as part:
-            for subpart in self.parts:
-                part_depth = subpart.bounding_box().size.Z
-                bd.add(subpart.move(bd.Location((0, 0, offset_z))))
-                offset_z += part_depth
-        super().__init__(part=part.part, rotation=self.rotation,
+        for i, layer in enumerate(self.layers):
+            # Built grids are placed, but the stack only uses their specification: don't ignore their placement
+            if isinstance(layer, GridBase) and (layer.align is not None or
+                                                layer.rotation.orientation != bd.Vector(0, 0, 0)):
+                raise ValueError(f"Layer {i} of the grid stack is placed (rotation="
+                                 f"{layer.rotation.orientation.to_tuple()}, align={layer.align}), but layers are "
+                                 f"stacked unplaced: place the stack instead")
+        super().__init__(part=cached_part(self, self._build_part), rotation=self.rotation,
                          align=self.align, mode=self.mode)
 
+    def _build_part(self) -> bd.Part:
+        offsets = self.layer_offsets()
+        if len(self.layers) > 1 and len({layer.outline_key for layer in self.layers}) == 1:
+            # Fast path: a single prism of the shared outline, with the holes of every layer cut at once (instead of
+            # fusing fully holed slabs). Hole prisms come from the fastener catalog and share their geometry.
+            body = bd.extrude(self.layers[0]._build_outline(), amount=offsets[-1], mode=bd.Mode.PRIVATE)
+            tools = []
+            for layer, offset_z in zip(self.layers, offsets):
+                hole = layer.hole_tool()
+                tools.extend(located(hole, bd.Location((0, 0, offset_z)) * loc) for loc in layer.hole_locations())
+            return cut_all(body, tools)
+        # A single layer, or different outlines: fuse the slabs, with a single boolean
+        slabs = [bd.extrude(layer.build_sketch(bd.Plane.XY.offset(offset_z)), amount=layer.sketch_depth,
+                            mode=bd.Mode.PRIVATE) for layer, offset_z in zip(self.layers, offsets)]
+        return slabs[0].fuse(*slabs[1:]).clean() if len(slabs) > 1 else slabs[0]
+
+    def layer_offsets(self) -> list[float]:
+        """The Z of the bottom of each layer, followed by the total height"""
+        offsets = [0.0]
+        for layer in self.layers:
+            offsets.append(offsets[-1] + layer.sketch_depth)
+        return offsets
+
+    def hole_wires(self, layer: int = 0) -> list[bd.Wire]:
+        """The wires of the holes of a layer at its bottom, in the coordinates of the stack before it is placed"""
+        offset_z = self.layer_offsets()[layer]
+        return [located(wire, bd.Location((0, 0, offset_z))) for wire in self.layers[layer].hole_wires()]
+
 
 if __name__ == "__main__":
-    conn_grid = GridStack(parts=[GridNutHoles(repeat=Grid2D(4, 3)), GridScrewThreadHoles(
-        repeat=Grid2D(4, 7), wrapped_screw_length=8), GridScrewHeadHoles(repeat=Grid2D(4, 5))])
-    yacv.show_all()
+    conn_grid = GridStack(layers=[GridNutHolesLayer(repeat=Grid2D(4, 3)), GridScrewThreadHolesLayer(
+        repeat=Grid2D(4, 7), wrapped_screw_length=8), GridScrewHeadHolesLayer(repeat=Grid2D(4, 5))])
+    show_all()
     if os.getenv('CI', '') != '':
-        yacv.export_all(os.path.join(os.path.dirname(__file__), '..', 'export'))
+        export_all(os.path.join(os.path.dirname(__file__), '..', 'export'))
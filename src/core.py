@@ -1,13 +1,20 @@
 # %%
 import os
+from dataclasses import dataclass
 from math import cos, radians, sin, degrees, atan2
+from typing import Optional
 
 from build123d import *
-from yacv_server import show_all, export_all
 
-from src.conn_grid import GridBase, GridStack, GridScrewThreadHoles, Grid2D, Grid2DF, GridNutHoles
-from src.global_params import wall, bbox_to_box, tol
+from src.cache import Stage
+from src.conn_grid import GridBase, GridStack, GridScrewThreadHolesLayer, Grid2D, Grid2DF, GridNutHolesLayer
+from src.fasteners import Fastener, M5
+from src.global_params import wall, bbox_to_box, tol, cut_all, is_draft
+from src.profiling import stage
 from src.screwable_cylinder import ScrewableCylinder
+from src.topology import topology_index
+from src.validation import checkpoint
+from src.viewer import show_all, export_all
 
 stem_max_width = 38
 stem_max_height = 38
@@ -16,14 +23,57 @@ stem_side_bulge = 1  # Removed as an arc from max_width/height until fillet poin
 stem_length = 30
 
 pattern_side_len = GridBase.dimensions
-grid = Grid2D(int((stem_max_width + 2 * wall) // pattern_side_len.x),
-              int(stem_length // pattern_side_len.y))
-grid_dim = Grid2DF(stem_max_width + 2 * wall, stem_length)
 
 
-def build_core():
-    # Prepare the stem_wrapper
-    with BuildPart() as stem_wrapper:
+@dataclass(kw_only=True)
+class CoreParams:
+    stem_max_width: float = stem_max_width
+    stem_max_height: float = stem_max_height
+    stem_fillet: float = stem_fillet
+    stem_side_bulge: float = stem_side_bulge
+    stem_length: float = stem_length
+    grid: Optional[Grid2D] = None  # Defaults to as many cells as fit in the top/bottom faces
+    grid_dim: Optional[Grid2DF] = None  # Defaults to the full top/bottom faces
+    fillet_radius: float = wall / 1.01
+    fastener: Fastener = M5  # Of the side screw holes and of the top/bottom nut grids
+
+    def __post_init__(self):
+        self.grid = self.grid or Grid2D(int((self.stem_max_width + 2 * wall) // pattern_side_len.x),
+                                        int(self.stem_length // pattern_side_len.y))
+        self.grid_dim = self.grid_dim or Grid2DF(self.stem_max_width + 2 * wall, self.stem_length)
+
+
+default_params = CoreParams()
+grid, grid_dim = default_params.grid, default_params.grid_dim
+
+
+def build_core(params: CoreParams = default_params) -> Part:
+    return checkpoint('core', core_stages(params)[-1].result(), level='final', solids=2)
+
+
+def core_stages(params: CoreParams) -> list[Stage]:
+    """The checkpointed stages of the core, each keyed by only the parameters it reads.
+
+    Tweaking the nut grid or the final fillet only rebuilds from that stage on."""
+    stem_wrapper = Stage('stem_wrapper', dict(
+        stem_max_width=params.stem_max_width, stem_max_height=params.stem_max_height,
+        stem_fillet=params.stem_fillet, stem_side_bulge=params.stem_side_bulge, stem_length=params.stem_length),
+                         _build_stem_wrapper)
+    screw_hole_adapter = Stage('screw_hole_adapter', dict(fastener=params.fastener), _build_screw_hole_adapter,
+                               stem_wrapper)
+    supports = Stage('supports', dict(nut_height=params.fastener.nut_height),
+                     _build_supports, screw_hole_adapter, stem_wrapper)
+    body = Stage('body', {}, _build_body, supports, stem_wrapper)
+    nut_grids = Stage('nut_grids', dict(grid=params.grid, grid_dim=params.grid_dim, stem_fillet=params.stem_fillet,
+                                        fastener=params.fastener), _build_nut_grids, body)
+    fillets = Stage('fillets', dict(fillet_radius=params.fillet_radius), _build_fillets, nut_grids)
+    halves = Stage('halves', {}, _build_halves, fillets)
+    return [stem_wrapper, screw_hole_adapter, supports, body, nut_grids, fillets, halves]
+
+
+def _build_stem_wrapper(*, stem_max_width: float, stem_max_height: float, stem_fillet: float,
+                        stem_side_bulge: float, stem_length: float) -> Part:
+    with stage('stem_wrapper', lambda: stem_wrapper.part), BuildPart() as stem_wrapper:
         with BuildSketch(Plane.front):
             # Outer top/bottom/sides are flat
             Rectangle(stem_max_width + 2 * wall, stem_max_height + 2 * wall)
@@ -44,94 +94,138 @@ def build_core():
                 mirror(about=Plane.XY)
             make_face(mode=Mode.SUBTRACT)
         extrude(amount=stem_length / 2, both=True)
-        RigidJoint("right", stem_wrapper, faces().group_by(Axis.X)[-1].face().center_location)
-    stem_wrapper = stem_wrapper.part
+    return checkpoint('stem_wrapper', stem_wrapper.part, solids=1)
+
 
+def _build_screw_hole_adapter(stem_wrapper: Part, *, fastener: Fastener) -> Part:
     # Prepare the screw hole adapter
-    screw_hole_base = ScrewableCylinder()
-    bb = screw_hole_base.bounding_box()
-    eps_offset_loft = 0.01  # Causes broken geometry if too small
-    RigidJoint("left", screw_hole_base, Location(
-        (bb.min.X - eps_offset_loft, bb.center().Y, bb.center().Z), (0, 90, 0)))
-    stem_wrapper.joints["right"].connect_to(screw_hole_base.joints["left"])
+    with stage('screw_hole_base', lambda: screw_hole_base):
+        RigidJoint("right", stem_wrapper, stem_wrapper.faces().group_by(Axis.X)[-1].face().center_location)
+        screw_hole_base = ScrewableCylinder(fastener=fastener)
+        bb = screw_hole_base.bounding_box()
+        eps_offset_loft = 0.01  # Causes broken geometry if too small
+        RigidJoint("left", screw_hole_base, Location(
+            (bb.min.X - eps_offset_loft, bb.center().Y, bb.center().Z), (0, 90, 0)))
+        stem_wrapper.joints["right"].connect_to(screw_hole_base.joints["left"])
 
     with BuildPart() as core:
         # Add the placed screw_hole base
         add(screw_hole_base)
 
         # Attach the screw hole adapter to the stem_wrapper
-        loft_bb: BoundBox = core.part.bounding_box()
-        loft_bb.min.X -= loft_bb.size.X / 2
-        loft_bb.min.X -= loft_bb.size.X / 2
-        loft_screw_hole_face = screw_hole_base.faces().group_by(SortBy.AREA)[-1].face() & bbox_to_box(loft_bb)
-        loft_stem_face = stem_wrapper.faces().group_by(Axis.X)[-1].face() & bbox_to_box(loft_bb)
-        add(loft([loft_stem_face, loft_screw_hole_face]))
-        assert core.part.is_valid()
-        assert len(core.part.solids()) == 1
-        core.part = core.part.clean()
+        with stage('loft', lambda: core.part):
+            loft_bb: BoundBox = core.part.bounding_box()
+            loft_bb.min.X -= loft_bb.size.X / 2
+            loft_bb.min.X -= loft_bb.size.X / 2
+            loft_screw_hole_face = screw_hole_base.faces().group_by(SortBy.AREA)[-1].face() & bbox_to_box(loft_bb)
+            loft_stem_face = stem_wrapper.faces().group_by(Axis.X)[-1].face() & bbox_to_box(loft_bb)
+            add(loft([loft_stem_face, loft_screw_hole_face]))
+            checkpoint('loft', core.part, level='paranoid', solids=1)
+            core.part = core.part.clean()
+    return checkpoint('screw_hole_adapter', core.part, solids=1)
+
+
+def _build_supports(screw_hole_adapter: Part, stem_wrapper: Part, *, nut_height: float) -> Part:
+    with BuildPart() as core:
+        core.part = screw_hole_adapter
 
         # Make it 3D printable by adding top and bottom supports
         for face_side in [-1, 1]:  # Bottom and top
+            side_name = 'bottom' if face_side < 0 else 'top'
             face_search = 0 if face_side < 0 else -1
-            bottom_face = faces().group_by(Axis.Z)[face_search].face()
-            extreme = stem_wrapper.bounding_box().min if face_side < 0 else stem_wrapper.bounding_box().max
-            extreme.Z += face_side * (screw_hole_base.nut_height + 2 * tol)
-            max_extrude = bottom_face.center().Z - extreme.Z
-            extrude(bottom_face, amount=abs(max_extrude))
-            assert core.part.is_valid()
-            # Prepare a cut plane
-            max_offset = bottom_face.bounding_box().size.X
-            cut_plane_angle = degrees(atan2(max_extrude, max_offset))
-            print(cut_plane_angle)
-            bb = bottom_face.bounding_box()
-            cut_plane = Plane(Location((bb.max.X, bb.center().Y, bb.center().Z), (0, -cut_plane_angle, 0)))
-            split(bisect_by=cut_plane, keep=Keep.TOP if face_side < 0 else Keep.BOTTOM)
-            assert core.part.is_valid()
-            assert len(core.part.solids()) == 1
-            # Fillet outer edges of supports
-            new_face = faces().group_by(Axis.Z)[face_search].face()
-            fillet(new_face.edges() - new_face.edges().group_by(Axis.X)[0], wall / 2.5)  # Finicky
+            with stage(f'support_{side_name}_extrude', lambda: core.part):
+                bottom_face = topology_index(core.part).faces().group_by(Axis.Z)[face_search].face()
+                extreme = stem_wrapper.bounding_box().min if face_side < 0 else stem_wrapper.bounding_box().max
+                extreme.Z += face_side * (nut_height + 2 * tol)
+                max_extrude = bottom_face.center().Z - extreme.Z
+                extrude(bottom_face, amount=abs(max_extrude))
+                checkpoint(f'support_{side_name}_extrude', core.part, level='paranoid')
+            with stage(f'support_{side_name}_split', lambda: core.part):
+                # Prepare a cut plane
+                max_offset = bottom_face.bounding_box().size.X
+                cut_plane_angle = degrees(atan2(max_extrude, max_offset))
+                bb = bottom_face.bounding_box()
+                cut_plane = Plane(Location((bb.max.X, bb.center().Y, bb.center().Z), (0, -cut_plane_angle, 0)))
+                split(bisect_by=cut_plane, keep=Keep.TOP if face_side < 0 else Keep.BOTTOM)
+                checkpoint(f'support_{side_name}_split', core.part, level='paranoid', solids=1)
+            if not is_draft():  # Cosmetic
+                with stage(f'support_{side_name}_fillet', lambda: core.part):
+                    # Fillet outer edges of supports
+                    new_face = topology_index(core.part).faces().group_by(Axis.Z)[face_search].face()
+                    fillet(new_face.edges() - new_face.edges().group_by(Axis.X)[0], wall / 2.5)  # Finicky
+    return checkpoint('supports', core.part, solids=1)
+
+
+def _build_body(supports: Part, stem_wrapper: Part) -> Part:
+    with BuildPart() as core:
+        core.part = supports
 
         # Mirror to the other side
-        mirror(about=Plane.YZ)
+        with stage('mirror', lambda: core.part):
+            mirror(about=Plane.YZ)
 
         # Add the core stem_wrapper
-        add(stem_wrapper)
+        with stage('add_stem_wrapper', lambda: core.part):
+            add(stem_wrapper)
+    return checkpoint('body', core.part, solids=1)
+
+
+def _build_nut_grids(body: Part, *, grid: Grid2D, grid_dim: Grid2DF, stem_fillet: float, fastener: Fastener) -> Part:
+    with BuildPart() as core:
+        core.part = body
 
         # Add a top and bottom pattern to insert nuts to connect attachments, keeping it 3D-printable
         for face_side in [-1, 1]:  # Bottom and top
+            side_name = 'bottom' if face_side < 0 else 'top'
             face_search = 0 if face_side < 0 else -1
-            bottom_face: Face = faces().filter_by(
-                GeomType.PLANE).group_by(SortBy.AREA)[-1].group_by(Axis.Z)[face_search].face()
-            nut_holes = GridNutHoles(repeat=grid, total_dimensions=grid_dim, rounded=False)
-            with BuildPart(mode=Mode.PRIVATE) as grid_conn:
-                GridStack(parts=[nut_holes,
-                                 GridScrewThreadHoles(repeat=grid, wrapped_screw_length=wall,
-                                                      # Minimal screw length
-                                                      total_dimensions=grid_dim, rounded=False),
-                                 ])
-            place_at = Location((0, 0, bottom_face.center().Z), (0, 180 if face_side == -1 else 0, 0))
-            grid_conn_placed = grid_conn.part.moved(place_at)
-            add(grid_conn_placed)
+            with stage(f'grid_{side_name}_build', lambda: grid_conn.part):
+                bottom_face: Face = topology_index(core.part).faces().filter_by(
+                    GeomType.PLANE).group_by(SortBy.AREA)[-1].group_by(Axis.Z)[face_search].face()
+                with BuildPart(mode=Mode.PRIVATE) as grid_conn:
+                    grid_stack = GridStack(layers=[
+                        GridNutHolesLayer(repeat=grid, total_dimensions=grid_dim, rounded=False, fastener=fastener),
+                        GridScrewThreadHolesLayer(repeat=grid, wrapped_screw_length=wall,  # Minimal screw length
+                                                  total_dimensions=grid_dim, rounded=False, fastener=fastener),
+                    ])
+            with stage(f'grid_{side_name}_add', lambda: core.part):
+                place_at = Location((0, 0, bottom_face.center().Z), (0, 180 if face_side == -1 else 0, 0))
+                grid_conn_placed = grid_conn.part.moved(place_at)
+                add(grid_conn_placed)
 
             # Break inner top/bottom surfaces
-            bottom_face = grid_conn.faces().group_by(Axis.Z)[0].face()
-            bottom_face_inner_edges = bottom_face.edges() - bottom_face.outer_wire().edges()
-            for wire in Wire.combine(bottom_face_inner_edges):
-                extrude(Face(wire).move(place_at), amount=-stem_fillet, mode=Mode.SUBTRACT)
+            with stage(f'grid_{side_name}_cut', lambda: core.part):
+                core.part = cut_all(core.part, [extrude(Face(wire).move(place_at), amount=-stem_fillet,
+                                                        mode=Mode.PRIVATE)
+                                                for wire in grid_stack.hole_wires()])
+    return checkpoint('nut_grids', core.part, solids=1)
+
+
+def _build_fillets(nut_grids: Part, *, fillet_radius: float) -> Part:
+    if is_draft():  # Cosmetic
+        return nut_grids
+    with BuildPart() as core:
+        core.part = nut_grids
 
         # Final fillets
-        to_fillet = edges().group_by(Axis.Y)[0] + edges().group_by(Axis.Y)[-1] + \
-                    edges().group_by(Axis.Z)[-1] + edges().group_by(Axis.Z)[0]
-        to_fillet -= to_fillet.filter_by(GeomType.CIRCLE)  # Inner top/bottom circles
-        to_fillet -= to_fillet.filter_by(GeomType.BSPLINE)  # Inner section of stem
-        fillet(to_fillet, wall / 1.01)
+        with stage('fillet', lambda: core.part):
+            part_edges = topology_index(core.part).edges
+            to_fillet = part_edges().group_by(Axis.Y)[0] + part_edges().group_by(Axis.Y)[-1] + \
+                        part_edges().group_by(Axis.Z)[-1] + part_edges().group_by(Axis.Z)[0]
+            to_fillet -= to_fillet.filter_by(GeomType.CIRCLE)  # Inner top/bottom circles
+            to_fillet -= to_fillet.filter_by(GeomType.BSPLINE)  # Inner section of stem
+            fillet(to_fillet, fillet_radius)
+    return checkpoint('fillets', core.part, solids=1)
 
-        # Cut the hole piece in two, to be connected by screws
-        bb = core.part.bounding_box()
-        Box(bb.size.X, bb.size.Y, 2 * wall, align=(Align.CENTER, Align.CENTER, Align.MIN), mode=Mode.SUBTRACT)
 
-    return core
+def _build_halves(fillets: Part) -> Part:
+    with BuildPart() as core:
+        core.part = fillets
+
+        # Cut the hole piece in two, to be connected by screws
+        with stage('split_halves', lambda: core.part):
+            bb = core.part.bounding_box()
+            Box(bb.size.X, bb.size.Y, 2 * wall, align=(Align.CENTER, Align.CENTER, Align.MIN), mode=Mode.SUBTRACT)
+    return core.part
 
 
 if __name__ == "__main__":
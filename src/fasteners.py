@@ -0,0 +1,91 @@
+# Catalog of metric fasteners and their hole tools, which are built once per process and shared by all users
+from dataclasses import dataclass
+from functools import cache
+from typing import Optional, TypeVar
+
+import build123d as bd
+
+from src.global_params import tol
+
+T = TypeVar('T', bound=bd.Shape)
+
+
+@dataclass(frozen=True)
+class Fastener:
+    """A socket head cap screw (ISO 4762) with its hex nut (DIN 934), in mm"""
+    size: str
+    screw_diameter: float
+    screw_head_diameter: float
+    screw_head_height: float
+    nut_inscribed_diameter: float  # Width across flats
+    nut_height: float
+
+    # 2D profiles centered at the origin, enlarged by the clearance
+
+    def nut_profile(self, clearance: float = 0, location: bd.Location = None) -> bd.Face:
+        return located(_profile(self, 'nut', clearance), location)
+
+    def head_profile(self, clearance: float = 0, location: bd.Location = None) -> bd.Face:
+        return located(_profile(self, 'head', clearance), location)
+
+    def thread_profile(self, clearance: float = 0, location: bd.Location = None) -> bd.Face:
+        return located(_profile(self, 'thread', clearance), location)
+
+    # Hole tools (to subtract), extruded up from the XY plane at their location and enlarged by the clearance
+
+    def nut_hole(self, depth: Optional[float] = None, clearance: float = tol,
+                 location: bd.Location = None) -> bd.Solid:
+        return located(_hole(self, 'nut', self.nut_height if depth is None else depth, clearance), location)
+
+    def head_hole(self, depth: Optional[float] = None, clearance: float = tol,
+                  location: bd.Location = None) -> bd.Solid:
+        return located(_hole(self, 'head', self.screw_head_height if depth is None else depth, clearance), location)
+
+    def thread_hole(self, length: float, clearance: float = tol, location: bd.Location = None) -> bd.Solid:
+        return located(_hole(self, 'thread', length, clearance), location)
+
+
+fasteners: dict[str, Fastener] = {fastener.size: fastener for fastener in [
+    Fastener(size='M2', screw_diameter=2, screw_head_diameter=3.8, screw_head_height=2,
+             nut_inscribed_diameter=4, nut_height=1.6),
+    Fastener(size='M2.5', screw_diameter=2.5, screw_head_diameter=4.5, screw_head_height=2.5,
+             nut_inscribed_diameter=5, nut_height=2),
+    Fastener(size='M3', screw_diameter=3, screw_head_diameter=5.5, screw_head_height=3,
+             nut_inscribed_diameter=5.5, nut_height=2.4),
+    Fastener(size='M4', screw_diameter=4, screw_head_diameter=7, screw_head_height=4,
+             nut_inscribed_diameter=7, nut_height=3.2),
+    Fastener(size='M5', screw_diameter=5, screw_head_diameter=8.5, screw_head_height=5,
+             nut_inscribed_diameter=8, nut_height=4),
+    Fastener(size='M6', screw_diameter=6, screw_head_diameter=10, screw_head_height=6,
+             nut_inscribed_diameter=10, nut_height=5),
+    Fastener(size='M8', screw_diameter=8, screw_head_diameter=13, screw_head_height=8,
+             nut_inscribed_diameter=13, nut_height=6.5),
+]}
+
+M5 = fasteners['M5']  # The default of all parts
+
+
+def located(shape: T, location: Optional[bd.Location] = None) -> T:
+    """A copy of the shape at the location that shares its geometry (unlike Shape.moved, which copies it).
+
+    Moving the copy in place does not affect the original, so cached shapes can be handed out safely."""
+    return type(shape)(shape.wrapped.Moved((location or bd.Location()).wrapped))
+
+
+@cache
+def _profile(fastener: Fastener, kind: str, clearance: float) -> bd.Face:
+    with bd.BuildSketch(mode=bd.Mode.PRIVATE) as profile:
+        if kind == 'nut':
+            bd.RegularPolygon(fastener.nut_inscribed_diameter / 2 + clearance, 6, major_radius=False)
+        elif kind == 'head':
+            bd.Circle(fastener.screw_head_diameter / 2 + clearance)
+        elif kind == 'thread':
+            bd.Circle(fastener.screw_diameter / 2 + clearance)
+        else:
+            raise ValueError(f"Unknown fastener profile {kind!r}")
+    return profile.sketch.face()
+
+
+@cache
+def _hole(fastener: Fastener, kind: str, depth: float, clearance: float) -> bd.Solid:
+    return bd.extrude(_profile(fastener, kind, clearance), amount=depth, mode=bd.Mode.PRIVATE).solid()
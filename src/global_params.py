@@ -1,3 +1,8 @@
+import os
+from typing import Iterable, Union
+
+from OCP.BRepAlgoAPI import BRepAlgoAPI_Cut
+from OCP.TopTools import TopTools_ListOfShape
 from build123d import *
 
 # 3D printing basics
@@ -6,8 +11,63 @@ wall_min = 0.4 * MM  # Minimum wall width
 wall = 3 * wall_min  # Recommended width for most walls of this print
 eps = 1e-5 * MM  # A small number
 
+# Boolean operations
+boolean_parallel = True  # Let OCCT use all cores for each boolean
+boolean_fuzzy = 0.0  # Fuzzy tolerance for boolean operations (0 disables fuzzy mode)
+
+# Build mode: 'final' builds the exact geometry to export, while 'draft' skips cosmetic fillets/chamfers and
+# validity checks and previews with a coarse tessellation, for fast interactive iteration
+build_modes = ('final', 'draft')
+build_mode = os.getenv('BUILD_MODE', 'final')
+draft_viewer_tolerances = dict(tolerance=1 * MM, angular_tolerance=0.5)  # Defaults are 0.1 and 0.1
+
 
 # Some common utilities
 
+def set_build_mode(mode: str):
+    """Select the build mode for this process and the build processes it starts"""
+    global build_mode
+    if mode not in build_modes:
+        raise ValueError(f"Unknown build mode {mode!r}, available: {', '.join(build_modes)}")
+    build_mode = os.environ['BUILD_MODE'] = mode
+
+
+def is_draft() -> bool:
+    return build_mode == 'draft'
+
+
+def viewer_options() -> dict:
+    """Extra options for yacv's show, to tessellate coarsely in draft mode"""
+    return dict(draft_viewer_tolerances) if is_draft() else {}
+
+
 def bbox_to_box(bb: BoundBox) -> Box:
     return Box(bb.size.X, bb.size.Y, bb.size.Z, mode=Mode.PRIVATE).translate(bb.center())
+
+
+def cut_all(part: Part, tools: Iterable[Union[Part, Solid]], parallel: bool = None, fuzzy: float = None,
+            clean: bool = True) -> Part:
+    """Cut all tools from the part with a single boolean, instead of reprocessing the growing part once per tool"""
+    tools = list(tools)
+    if not tools:
+        return part
+    arguments, tool_list = TopTools_ListOfShape(), TopTools_ListOfShape()
+    arguments.Append(part.wrapped)
+    for tool in tools:  # As separate arguments (not a compound), so that tools may overlap each other
+        tool_list.Append(tool.wrapped)
+    cut_op = BRepAlgoAPI_Cut()
+    cut_op.SetArguments(arguments)
+    cut_op.SetTools(tool_list)
+    cut_op.SetRunParallel(boolean_parallel if parallel is None else parallel)
+    fuzzy = boolean_fuzzy if fuzzy is None else fuzzy
+    if fuzzy > 0:
+        cut_op.SetFuzzyValue(fuzzy)
+    cut_op.Build()
+    if not cut_op.IsDone():
+        raise ValueError(f"Failed cutting {len(tools)} tools from the part")
+    result = Part(cut_op.Shape())
+    return result.clean() if clean else result
+
+
+if build_mode not in build_modes:
+    raise ValueError(f"Unknown build mode {build_mode!r} in BUILD_MODE, available: {', '.join(build_modes)}")
@@ -0,0 +1,67 @@
+# Manifest of the exported objects, to skip exporting again the ones whose geometry did not change
+import hashlib
+import json
+import logging
+import os
+from typing import Optional
+
+import build123d as bd
+
+from src.cache import shape_to_brep
+
+logger = logging.getLogger(__name__)
+
+manifest_name = 'manifest.json'
+
+
+def signature(shape: bd.Shape, brep: Optional[bytes] = None, digits: int = 6) -> dict:
+    """Geometric summary of a shape, with a hash of its BREP (if already serialized, as given) that changes with any
+    change of its geometry, even if the totals don't (e.g. a moved hole). Different serializations of the same
+    geometry (e.g. after parallel booleans) only cost a redundant export. The shape is not modified (nor meshed)."""
+    bb = shape.bounding_box()
+    return {
+        'volume': round(shape.volume, digits),
+        'area': round(shape.area, digits),
+        'bbox': [round(v, digits) for v in (*bb.min.to_tuple(), *bb.max.to_tuple())],
+        'topology': {kind: len(getattr(shape, kind)()) for kind in ('solids', 'faces', 'edges', 'vertices')},
+        'brep': hashlib.sha256(shape_to_brep(shape) if brep is None else brep).hexdigest(),
+    }
+
+
+def fingerprint(params: dict, shape_signature: dict) -> str:
+    """Content fingerprint of an export: the parameters it was made with and the signature of its geometry"""
+    return hashlib.sha256(json.dumps({'params': params, 'signature': shape_signature},
+                                     sort_keys=True, default=repr).encode()).hexdigest()
+
+
+class Manifest:
+    """The fingerprint and files of each object exported to a folder"""
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.path = os.path.join(folder, manifest_name)
+        self.entries: dict[str, dict] = {}
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (ValueError, OSError) as e:
+            logger.warning("Ignoring unreadable export manifest %s: %s", self.path, e)
+
+    def is_current(self, name: str, object_fingerprint: str) -> bool:
+        """Whether the object was already exported with the same fingerprint, and its files are still there"""
+        entry: Optional[dict] = self.entries.get(name)
+        return entry is not None and entry['fingerprint'] == object_fingerprint and all(
+            os.path.exists(os.path.join(self.folder, file)) for file in entry['files'])
+
+    def update(self, name: str, object_fingerprint: str, params: dict, shape_signature: dict, files: list[str]):
+        self.entries[name] = {'fingerprint': object_fingerprint, 'params': params, 'signature': shape_signature,
+                              'files': sorted(os.path.relpath(file, self.folder) for file in files)}
+
+    def save(self):
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True, default=repr)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,255 @@
+# Tessellate parts in parallel at several levels of detail and stream them to binary STL or 3MF files
+import logging
+import os
+import struct
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional, Union
+
+import build123d as bd
+import numpy as np
+from OCP.BRep import BRep_Tool
+from OCP.BRepMesh import BRepMesh_IncrementalMesh
+from OCP.BRepTools import BRepTools
+from OCP.TopAbs import TopAbs_REVERSED
+from OCP.TopLoc import TopLoc_Location
+
+from src.cache import shape_from_brep, shape_to_brep
+
+logger = logging.getLogger(__name__)
+
+formats = ('stl', '3mf')
+
+
+@dataclass(frozen=True)
+class Lod:
+    """A level of detail, written to `<part>-<name>.<format>`"""
+    name: str
+    linear_deflection: float  # Maximum distance from the mesh to the surface (mm)
+    angular_deflection: float  # Maximum angle between the normals of adjacent triangles (radians)
+
+
+# Like the allen key scans, which are kept as allen-full.glb and allen-lowpoly.glb
+default_lods = (Lod('full', linear_deflection=0.01 * bd.MM, angular_deflection=0.1),
+                Lod('lowpoly', linear_deflection=0.1 * bd.MM, angular_deflection=0.5))
+
+
+@dataclass
+class MeshReport:
+    part: str
+    lod: str
+    format: str
+    path: str
+    triangles: int
+    size: int  # Bytes
+    seconds: float  # Tessellating (shared by the formats of a LOD) and writing
+
+
+# ================== TESSELLATION ==================
+
+
+def tessellate(shape: bd.Shape, lod: Lod) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """Mesh the shape at the level of detail, yielding the vertices (n x 3) and triangles (m x 3, indexing the
+    vertices) of each face, with triangles oriented outwards"""
+    BRepTools.Clean_s(shape.wrapped)  # Otherwise, a finer existing mesh would be kept
+    BRepMesh_IncrementalMesh(shape.wrapped, lod.linear_deflection, False, lod.angular_deflection, True)
+    for face in shape.faces():
+        location = TopLoc_Location()
+        triangulation = BRep_Tool.Triangulation_s(face.wrapped, location)
+        if triangulation is None:
+            continue
+        transform = location.Transformation()
+        vertices = np.array([triangulation.Node(i).Transformed(transform).Coord()
+                             for i in range(1, triangulation.NbNodes() + 1)], dtype=np.float64)
+        triangles = np.array([triangulation.Triangle(i).Get() for i in range(1, triangulation.NbTriangles() + 1)],
+                             dtype=np.uint32) - 1
+        if face.wrapped.Orientation() == TopAbs_REVERSED:
+            triangles = triangles[:, ::-1]
+        yield vertices, triangles
+
+
+def merge_chunks(chunks: Iterable[tuple[np.ndarray, np.ndarray]]) -> tuple[np.ndarray, np.ndarray]:
+    """A single mesh from per-face chunks, sharing the vertices of the edges between faces (so that it is manifold)"""
+    vertices, triangles, offset = [], [], 0
+    for chunk_vertices, chunk_triangles in chunks:
+        vertices.append(chunk_vertices)
+        triangles.append(chunk_triangles + offset)
+        offset += len(chunk_vertices)
+    if not vertices:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.uint32)
+    # The nodes of an edge only match up to floating point noise in the meshes of its faces
+    vertices, inverse = np.unique(np.round(np.concatenate(vertices), 9), axis=0, return_inverse=True)
+    triangles = inverse.reshape(-1)[np.concatenate(triangles)].astype(np.uint32)
+    # Drop the triangles that merging made degenerate
+    triangles = triangles[(triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) &
+                          (triangles[:, 2] != triangles[:, 0])]
+    return vertices, triangles
+
+
+# ================== WRITERS ==================
+
+
+_stl_dtype = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attributes', '<u2')])
+
+
+class StlWriter:
+    """Binary STL writer that streams the triangles of each chunk to the file, without keeping the whole mesh"""
+
+    def __init__(self, path: str, name: str = ''):
+        self.file = open(path, 'wb')
+        self.file.write(f'{name} (build123d)'.encode()[:80].ljust(80, b'\0'))
+        self.file.write(struct.pack('<I', 0))  # Triangle count, written when closing
+        self.triangles = 0
+
+    def write(self, vertices: np.ndarray, triangles: np.ndarray):
+        records = np.zeros(len(triangles), dtype=_stl_dtype)
+        corners = vertices[triangles]
+        normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        records['normal'] = np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+        records['vertices'] = corners
+        self.file.write(records.tobytes())
+        self.triangles += len(triangles)
+
+    def close(self):
+        self.file.seek(80)
+        self.file.write(struct.pack('<I', self.triangles))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_3mf_content_types = '''<?xml version="1.0" encoding="UTF-8"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>
+</Types>'''
+
+_3mf_rels = '''<?xml version="1.0" encoding="UTF-8"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Target="/3D/3dmodel.model" Id="rel0"
+ Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>
+</Relationships>'''
+
+
+class ThreeMfWriter:
+    """3MF writer that streams each mesh object to the (compressed) model, which is never fully kept in memory.
+
+    Objects are placed on the build plate by items, so the same object can be printed several times (instanced)
+    with different transforms."""
+
+    def __init__(self, path: str):
+        self.zip = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED)
+        self.zip.writestr('[Content_Types].xml', _3mf_content_types)
+        self.zip.writestr('_rels/.rels', _3mf_rels)
+        self.model = self.zip.open('3D/3dmodel.model', 'w', force_zip64=True)
+        self.model.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<model unit="millimeter" xml:lang="en-US" '
+                         b'xmlns="http://schemas.microsoft.com/3dmanufacturing/core/2015/02">\n<resources>\n')
+        self.items: list[str] = []
+        self.objects = 0
+        self.triangles = 0
+
+    def add_object(self, name: str, vertices: np.ndarray, triangles: np.ndarray) -> int:
+        """Write a mesh object, returning its id (for items)"""
+        self.objects += 1
+        name = name.replace('&', '&amp;').replace('"', '&quot;').replace('<', '&lt;')
+        self.model.write(f'<object id="{self.objects}" type="model" name="{name}">\n<mesh>\n<vertices>\n'.encode())
+        for start in range(0, len(vertices), 65536):  # Bounded formatting buffers
+            self.model.write(''.join('<vertex x="%.9g" y="%.9g" z="%.9g"/>\n' % tuple(v)
+                                     for v in vertices[start:start + 65536].tolist()).encode())
+        self.model.write(b'</vertices>\n<triangles>\n')
+        for start in range(0, len(triangles), 65536):
+            self.model.write(''.join('<triangle v1="%d" v2="%d" v3="%d"/>\n' % tuple(t)
+                                     for t in triangles[start:start + 65536].tolist()).encode())
+        self.model.write(b'</triangles>\n</mesh>\n</object>\n')
+        self.triangles += len(triangles)
+        return self.objects
+
+    def add_item(self, object_id: int, transform: Optional[bd.Location] = None):
+        """Place an object on the build plate, at the location if given"""
+        if transform is None:
+            self.items.append(f'<item objectid="{object_id}"/>\n')
+            return
+        matrix = transform.wrapped.Transformation()
+        # 3MF transforms are 3x4 matrices in row-vector order: the rotation columns, then the translation
+        values = [matrix.Value(row, col) for col in range(1, 5) for row in range(1, 4)]
+        self.items.append(f'<item objectid="{object_id}" transform="{" ".join("%.9g" % v for v in values)}"/>\n')
+
+    def close(self):
+        self.model.write(f'</resources>\n<build>\n{"".join(self.items)}</build>\n</model>\n'.encode())
+        self.model.close()
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# ================== EXPORT ==================
+
+
+def export_lod(name: str, shape: bd.Shape, lod: Lod, folder: str,
+               export_formats: tuple[str, ...] = ('stl',)) -> list[MeshReport]:
+    """Tessellate the part once at the level of detail and write it in each format. The chunks are streamed to the
+    STL file as they are meshed, and only kept (to be merged) if a 3MF is also written."""
+    if unknown := set(export_formats) - set(formats):
+        raise ValueError(f"Unknown mesh formats {', '.join(sorted(unknown))}, available: {', '.join(formats)}")
+    start = time.time()
+    paths = {export_format: os.path.join(folder, f'{name}-{lod.name}.{export_format}')
+             for export_format in export_formats}
+    stl_writer = StlWriter(paths['stl'], name) if 'stl' in paths else None
+    chunks = [] if '3mf' in paths else None
+    triangle_counts, seconds = {}, {}
+    try:
+        for vertices, triangles in tessellate(shape, lod):
+            if stl_writer is not None:
+                stl_writer.write(vertices, triangles)
+            if chunks is not None:
+                chunks.append((vertices, triangles))
+    finally:
+        if stl_writer is not None:
+            stl_writer.close()
+    if stl_writer is not None:
+        triangle_counts['stl'], seconds['stl'] = stl_writer.triangles, time.time() - start
+    if chunks is not None:
+        with ThreeMfWriter(paths['3mf']) as writer:
+            writer.add_item(writer.add_object(name, *merge_chunks(chunks)))
+        triangle_counts['3mf'], seconds['3mf'] = writer.triangles, time.time() - start
+    return [MeshReport(name, lod.name, export_format, path, triangle_counts[export_format], os.path.getsize(path),
+                       seconds[export_format]) for export_format, path in paths.items()]
+
+
+def _export_lod(name: str, data: bytes, lod: Lod, folder: str, export_formats: tuple[str, ...]) -> list[MeshReport]:
+    """Worker entry point: parts are passed between processes as serialized BREPs"""
+    return export_lod(name, shape_from_brep(data), lod, folder, export_formats)
+
+
+def export_meshes(parts: dict[str, Union[bd.Shape, bytes]], folder: str, export_formats: tuple[str, ...] = ('stl',),
+                  lods: tuple[Lod, ...] = default_lods, jobs: int = None) -> list[MeshReport]:
+    """Tessellate and write every level of detail of every part in parallel worker processes"""
+    if unknown := set(export_formats) - set(formats):
+        raise ValueError(f"Unknown mesh formats {', '.join(sorted(unknown))}, available: {', '.join(formats)}")
+    os.makedirs(folder, exist_ok=True)
+    parts = {name: part if isinstance(part, bytes) else shape_to_brep(part) for name, part in parts.items()}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_export_lod, name, data, lod, folder, export_formats)
+                   for name, data in parts.items() for lod in lods]
+        reports = [report for future in futures for report in future.result()]
+    logger.info("Exported meshes:\n%s", summary(reports))
+    return reports
+
+
+def summary(reports: list[MeshReport]) -> str:
+    rows = [('file', 'triangles', 'size (KiB)', 'seconds')]
+    for r in reports:
+        rows.append((os.path.basename(r.path), str(r.triangles), f'{r.size / 1024:.1f}', f'{r.seconds:.2f}'))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows)
@@ -0,0 +1,191 @@
+# Lay out built parts on print beds and write them as 3MF plates: `python -m src.plate [target[:copies] ...]`
+# Each part is oriented to print on its largest flat base, copies are packed by their footprints, and every copy of a
+# part is an instance (a transformed item) of a single mesh object.
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import NamedTuple
+
+import build123d as bd
+import numpy as np
+
+from src.cache import shape_from_brep, shape_to_brep
+from src.mesh_export import Lod, ThreeMfWriter, default_lods, merge_chunks, tessellate
+
+logger = logging.getLogger(__name__)
+
+Bed = NamedTuple('Bed', [('x', float), ('y', float)])
+
+default_bed = Bed(256 * bd.MM, 256 * bd.MM)
+default_spacing = 5 * bd.MM  # Between parts, and from the edges of the bed
+base_tolerance = 0.05 * bd.MM  # How far the mesh may go below a base (its deflection, and numerical noise)
+
+
+@dataclass
+class PlateItem:
+    part: str
+    x: float  # Of the corner of the footprint closest to the origin of the bed
+    y: float
+    rotated: bool  # By 90 degrees around Z, so that the footprint is (depth, width)
+
+
+# ================== ORIENTATION ==================
+
+
+def orient(shape: bd.Shape, lod: Lod) -> tuple[np.ndarray, np.ndarray, float]:
+    """Mesh the part resting on its largest planar face that is a base (no part of it is below that face), with the
+    footprint starting at the origin. Returns the vertices, triangles and the area of the base."""
+    vertices, triangles = merge_chunks(tessellate(shape, lod))
+    faces = sorted(((face.area, face) for face in shape.faces().filter_by(bd.GeomType.PLANE)),
+                   key=lambda area_face: -area_face[0])
+    for area, face in faces:
+        normal = face.normal_at()  # Outwards: the base must face down
+        height = np.dot(face.vertices()[0].to_tuple(), normal.to_tuple())
+        if (vertices @ np.array(normal.to_tuple())).max() <= height + base_tolerance:
+            break
+    else:  # No flat base (e.g. only curved faces), keep the modelled orientation
+        area, normal = 0.0, bd.Vector(0, 0, -1)
+    plane = bd.Plane(origin=(0, 0, 0), z_dir=-normal)
+    rotation = np.array([plane.x_dir.to_tuple(), plane.y_dir.to_tuple(), plane.z_dir.to_tuple()])
+    vertices = vertices @ rotation.T  # Proper rotation, so triangles keep facing outwards
+    return vertices - vertices.min(axis=0), triangles, area
+
+
+def _orient(name: str, data: bytes, lod: Lod) -> tuple[np.ndarray, np.ndarray]:
+    """Worker entry point: parts are passed between processes as serialized BREPs"""
+    start = time.time()
+    vertices, triangles, area = orient(shape_from_brep(data), lod)
+    logger.info("Oriented %s on a base of %.1f mm^2 in %.2f seconds", name, area, time.time() - start)
+    return vertices, triangles
+
+
+# ================== PACKING ==================
+
+
+def pack(footprints: dict[str, tuple[float, float]], copies: dict[str, int], bed: Bed = default_bed,
+         spacing: float = default_spacing) -> list[list[PlateItem]]:
+    """Pack the copies of the parts by their (x, y) footprints into as few beds as needed, returning the items of
+    each plate. First-fit decreasing-height shelves: fast, and good for the few, boxy parts of this project."""
+    width, depth = bed.x - 2 * spacing, bed.y - 2 * spacing  # Usable area, without the margin
+    rectangles = []
+    for name, (x, y) in footprints.items():
+        # Shelves are denser with the short side along Y, if the long side fits along X
+        rotated = (y > x and y <= width) or x > width
+        w, d = (y, x) if rotated else (x, y)
+        if w > width or d > depth:
+            raise ValueError(f"{name} ({x:.1f} x {y:.1f} mm) does not fit on the {bed.x:.0f} x {bed.y:.0f} mm bed")
+        rectangles.extend((name, w, d, rotated) for _ in range(copies.get(name, 1)))
+    rectangles.sort(key=lambda rectangle: -rectangle[2])
+
+    plates: list[list[PlateItem]] = []
+    shelves: list[list[list[float]]] = []  # Of each plate: [y, depth, used width] of each shelf
+    for name, w, d, rotated in rectangles:
+        for plate, plate_shelves in zip(plates, shelves):
+            shelf = next((shelf for shelf in plate_shelves if shelf[2] + w <= width and d <= shelf[1]), None)
+            if shelf is None:
+                top = plate_shelves[-1][0] + plate_shelves[-1][1] + spacing
+                if top + d > depth:
+                    continue
+                shelf = [top, d, 0.0]
+                plate_shelves.append(shelf)
+            break
+        else:
+            plate, shelf = [], [0.0, d, 0.0]
+            plates.append(plate)
+            shelves.append([shelf])
+        plate.append(PlateItem(name, spacing + shelf[2], spacing + shelf[0], rotated))
+        shelf[2] += w + spacing
+    return plates
+
+
+# ================== EXPORT ==================
+
+
+def item_location(item: PlateItem, footprint: tuple[float, float]) -> bd.Location:
+    """Where an oriented part (with its footprint starting at the origin) goes on the bed"""
+    if item.rotated:  # Rotating around Z moves the footprint to [-y, 0] x [0, x]
+        return bd.Location((item.x + footprint[1], item.y, 0), (0, 0, 90))
+    return bd.Location((item.x, item.y, 0))
+
+
+def write_plate(path: str, meshes: dict[str, tuple[np.ndarray, np.ndarray]], items: list[PlateItem]):
+    """A 3MF with each part's mesh once, and an item (instance) for each of its copies on the bed"""
+    with ThreeMfWriter(path) as writer:
+        object_ids = {name: writer.add_object(name, *meshes[name])
+                      for name in sorted({item.part for item in items})}
+        for item in items:
+            vertices = meshes[item.part][0]
+            writer.add_item(object_ids[item.part], item_location(item, tuple(vertices.max(axis=0)[:2])))
+
+
+def plate(parts: dict[str, bytes], copies: dict[str, int], path: str, bed: Bed = default_bed,
+          spacing: float = default_spacing, lod: Lod = default_lods[0], jobs: int = None) -> list[str]:
+    """Orient (in parallel), pack and write the parts to 3MF plates: `path`, or numbered after it if the copies need
+    more than one bed. Returns the written files."""
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {name: pool.submit(_orient, name, data, lod) for name, data in parts.items()}
+        meshes = {name: future.result() for name, future in futures.items()}
+    footprints = {name: tuple(vertices.max(axis=0)[:2]) for name, (vertices, _) in meshes.items()}
+    plates = pack(footprints, copies, bed, spacing)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    stem, extension = os.path.splitext(path)
+    paths = [path] if len(plates) == 1 else [f'{stem}-{i + 1}{extension}' for i in range(len(plates))]
+    for plate_path, items in zip(paths, plates):
+        write_plate(plate_path, meshes, items)
+        logger.info("Wrote %s: %d copies of %s, %.1f KiB", plate_path, len(items),
+                    ', '.join(sorted({item.part for item in items})), os.path.getsize(plate_path) / 1024)
+    return paths
+
+
+def split_solids(name: str, shape: bd.Shape) -> dict[str, bytes]:
+    """The separately printed pieces of a part (e.g. the halves of the core), by name"""
+    solids = shape.solids()
+    if len(solids) == 1:
+        return {name: shape_to_brep(solids[0])}
+    return {f'{name}-{i + 1}': shape_to_brep(solid) for i, solid in enumerate(solids)}
+
+
+if __name__ == "__main__":
+    from src.build import build, targets
+
+    parser = argparse.ArgumentParser(description="Build targets, orient them for printing and pack them in 3MF plates")
+    parser.add_argument('targets', nargs='*', metavar='TARGET[:COPIES]',
+                        help=f"targets to print, each with its number of copies (default: all exported ones, once): "
+                             f"{', '.join(targets)}")
+    parser.add_argument('--bed', default=f'{default_bed.x:g}x{default_bed.y:g}', help="bed size in mm, as XxY")
+    parser.add_argument('--spacing', type=float, default=default_spacing,
+                        help="distance between parts and from the edges of the bed, in mm")
+    parser.add_argument('--lod', choices=[lod.name for lod in default_lods], default=default_lods[0].name,
+                        help="level of detail of the meshes")
+    parser.add_argument('-o', '--output', default=os.path.join(os.path.dirname(__file__), '..', 'export', 'plate.3mf'),
+                        help="3MF file (numbered if more than one bed is needed)")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: CPU count)")
+    args = parser.parse_args()
+    requested = {}
+    for arg in args.targets or [name for name, t in targets.items() if t.export]:
+        name, _, count = arg.partition(':')
+        if name not in targets or (count and (not count.isdigit() or int(count) < 1)):
+            parser.error(f"invalid target {arg!r}, expected TARGET[:COPIES] with a target of: {', '.join(targets)}")
+        requested[name] = int(count or 1)
+    try:
+        bed = Bed(*map(float, args.bed.split('x')))
+    except (TypeError, ValueError):
+        parser.error(f"invalid bed size {args.bed!r}, expected XxY in mm")
+
+    logging.basicConfig(level=logging.INFO)
+    start = time.time()
+    built = build(list(requested), args.jobs)
+    if missing := set(requested) - set(built):
+        logger.error("Failed building %s", ', '.join(sorted(missing)))
+        sys.exit(1)
+    parts, copies = {}, {}
+    for name, count in requested.items():
+        for part_name, data in split_solids(name, shape_from_brep(built[name])).items():
+            parts[part_name], copies[part_name] = data, count
+    plate(parts, copies, args.output, bed, args.spacing, next(l for l in default_lods if l.name == args.lod),
+          args.jobs)
+    logger.info("Built the plates in %.2f seconds", time.time() - start)
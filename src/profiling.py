@@ -0,0 +1,105 @@
+import atexit
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from typing import Callable, Optional
+
+import build123d as bd
+
+logger = logging.getLogger(__name__)
+
+# Path of the Chrome trace (chrome://tracing, ui.perfetto.dev) to write at exit, which may contain {pid}.
+# Profiling is disabled (and free) if not set.
+profile_path = os.getenv('BUILD_PROFILE', '')
+
+
+@dataclass
+class StageRecord:
+    name: str
+    start: float  # Seconds since the epoch
+    wall: float  # Seconds
+    cpu: float  # Seconds (of this process)
+    peak_rss: int  # Bytes (of this process, since it started)
+    peak_rss_increase: int  # Bytes, of the peak rss reached during the stage over the peak before it
+    faces: Optional[int] = None
+    edges: Optional[int] = None
+    solids: Optional[int] = None
+
+
+def _peak_rss() -> int:
+    """Bytes, the highest resident set size of this process so far"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Profiler:
+    """Records the timing, memory and resulting topology of named build stages"""
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.records: list[StageRecord] = []
+
+    @contextmanager
+    def stage(self, name: str, shape: Callable[[], Optional[bd.Shape]] = None):
+        """Profile the enclosed stage, counting the topology of the (lazily evaluated) shape when it ends"""
+        if not self.enabled:
+            yield
+            return
+        start, start_cpu = time.time(), time.process_time()
+        start_rss = _peak_rss()
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            peak_rss = _peak_rss()
+            record = StageRecord(name, start, time.time() - start, time.process_time() - start_cpu, peak_rss,
+                                 peak_rss - start_rss)
+            # The shape may not exist if the stage failed, and that error must not be replaced
+            result = shape() if shape is not None and succeeded else None
+            if result is not None:
+                record.faces, record.edges, record.solids = \
+                    len(result.faces()), len(result.edges()), len(result.solids())
+            self.records.append(record)
+
+    def chrome_trace(self) -> dict:
+        pid, tid = os.getpid(), threading.get_ident()
+        return {'traceEvents': [{
+            'name': record.name, 'ph': 'X', 'pid': pid, 'tid': tid,
+            'ts': record.start * 1e6, 'dur': record.wall * 1e6,
+            'args': {k: v for k, v in asdict(record).items() if k not in ('name', 'start') and v is not None},
+        } for record in self.records]}
+
+    def summary(self) -> str:
+        rows = [('stage', 'wall (s)', 'cpu (s)', 'peak rss (MiB)', 'rss increase (MiB)', 'faces', 'edges', 'solids')]
+        for r in self.records:
+            rows.append((r.name, f'{r.wall:.3f}', f'{r.cpu:.3f}', f'{r.peak_rss / 2 ** 20:.1f}',
+                         f'{r.peak_rss_increase / 2 ** 20:.1f}',
+                         *(str(v) if v is not None else '' for v in (r.faces, r.edges, r.solids))))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows)
+
+    def write(self, path: str):
+        path = path.format(pid=os.getpid())
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        logger.info("Wrote build profile to %s:\n%s", path, self.summary())
+
+
+profiler = Profiler(enabled=profile_path != '')
+stage = profiler.stage
+
+
+def flush():
+    """Write the profile of this process so far. Worker processes must call this when their work is done, as they
+    exit without running atexit hooks."""
+    if profiler.enabled and profiler.records:
+        profiler.write(profile_path)
+
+
+if profiler.enabled:
+    atexit.register(flush)
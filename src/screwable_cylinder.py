@@ -5,9 +5,11 @@ from math import *
 from typing import Union
 
 from build123d import *
-import yacv_server as yacv
 
-from src.global_params import wall, tol
+from src.cache import cached_part
+from src.fasteners import Fastener, M5
+from src.global_params import wall, tol, cut_all
+from src.viewer import show_all, export_all
 
 
 # ================== MODELLING ==================
@@ -16,11 +18,7 @@ from src.global_params import wall, tol
 @dataclass(kw_only=True)
 class ScrewableCylinder(BasePartObject):
     screw_length: float = 12
-    screw_diameter: float = 5  # M5
-    screw_head_diameter: float = 8.5  # M5
-    screw_head_height: float = 5  # M5
-    nut_inscribed_diameter: float = 8  # M5
-    nut_height: float = 4  # M5
+    fastener: Fastener = M5
 
     wall_size: float = wall
     round: bool = False
@@ -30,33 +28,31 @@ class ScrewableCylinder(BasePartObject):
     mode: Mode = Mode.ADD
 
     def __post_init__(self):
+        super().__init__(part=cached_part(self, self._build_part), rotation=self.rotation,
+                         align=self.align, mode=self.mode)
+
+    def _build_part(self) -> Part:
+        fastener = self.fastener
         with BuildPart() as part:
-            total_height = self.screw_length + self.screw_head_height
+            total_height = self.screw_length + fastener.screw_head_height
             max_hole_diameter = max(
-                self.screw_diameter + 2 * tol, self.screw_head_diameter + 2 * tol,
-                (self.nut_inscribed_diameter + 2 * tol) / cos(radians(360 / 6 / 2)))
+                fastener.screw_diameter + 2 * tol, fastener.screw_head_diameter + 2 * tol,
+                (fastener.nut_inscribed_diameter + 2 * tol) / cos(radians(360 / 6 / 2)))
             # Core
             Cylinder(max_hole_diameter / 2 + self.wall_size, total_height)
             if self.round:
                 fillet(edges(), radius=self.wall_size)
-            # Top hole
-            with BuildSketch(faces() >> Axis.Z):
-                Circle(self.screw_head_diameter / 2 + tol)
-            extrude(amount=-self.screw_head_height, mode=Mode.SUBTRACT)
-            # Screw hole
-            Cylinder(self.screw_diameter / 2 + tol,
-                        self.screw_length, mode=Mode.SUBTRACT)
-            # Nut hole
-            with BuildSketch(faces() << Axis.Z):
-                RegularPolygon(self.nut_inscribed_diameter / 2 +
-                                  tol, 6, major_radius=False)
-            extrude(amount=-self.nut_height, mode=Mode.SUBTRACT)
-        super().__init__(part=part.part, rotation=self.rotation,
-                         align=self.align, mode=self.mode)
+            # Top hole, screw hole and nut hole, from the shared tools of the fastener
+            part.part = cut_all(part.part, [
+                fastener.head_hole(location=Pos(0, 0, total_height / 2 - fastener.screw_head_height)),
+                fastener.thread_hole(self.screw_length, location=Pos(0, 0, -self.screw_length / 2)),
+                fastener.nut_hole(location=Pos(0, 0, -total_height / 2)),
+            ])
+        return part.part
 
 
 if __name__ == "__main__":
     screwable_cylinder = ScrewableCylinder(rotation=(0, 0, 90))
-    yacv.show_all()
+    show_all()
     if os.getenv('CI', '') != '':
-        yacv.export_all(os.path.join(os.path.dirname(__file__), '..', 'export'))
+        export_all(os.path.join(os.path.dirname(__file__), '..', 'export'))
@@ -0,0 +1,156 @@
+# Build many variants of the core from a table of parameters: `python -m src.sweep stems.csv [-o folder]`
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+from dataclasses import dataclass, field, fields
+from typing import Any, Iterator, Optional
+
+from build123d import export_step, export_stl
+
+from src.conn_grid import Grid2D, Grid2DF
+from src.cache import cache_enabled
+from src.core import CoreParams, build_core, core_stages
+from src.fasteners import fasteners
+from src import profiling
+
+logger = logging.getLogger(__name__)
+
+formats = ('stl', 'step')
+
+shared_stage = 'body'  # The last stage before the variants usually diverge (nut grids, fillets)
+
+
+@dataclass
+class VariantResult:
+    name: str
+    status: str  # 'ok' or 'failed'
+    seconds: float
+    files: list[str] = field(default_factory=list)
+    error: Optional[str] = None
+
+
+# ================== TABLES ==================
+
+
+def parse_params(row: dict[str, Any]) -> CoreParams:
+    """CoreParams from a row of strings (or numbers): empty values keep their defaults, grids are written as `3x2`
+    and fasteners by their size (`M5`)"""
+    known = {f.name: f for f in fields(CoreParams)}
+    if unknown := set(row) - set(known):
+        raise ValueError(f"Unknown parameters {', '.join(sorted(unknown))}, available: {', '.join(known)}")
+    kwargs = {}
+    for name, value in row.items():
+        if value is None or value == '':
+            continue
+        if name == 'grid':
+            kwargs[name] = Grid2D(*map(int, str(value).split('x')))
+        elif name == 'grid_dim':
+            kwargs[name] = Grid2DF(*map(float, str(value).split('x')))
+        elif name == 'fastener':
+            kwargs[name] = fasteners[value]
+        else:
+            kwargs[name] = float(value)
+    return CoreParams(**kwargs)
+
+
+def load_table(path: str) -> dict[str, CoreParams]:
+    """Variants by name, from a CSV file with a header or a JSON list of objects, with an optional `name` column"""
+    with open(path, newline='') as f:
+        rows = json.load(f) if path.endswith('.json') else list(csv.DictReader(f))
+    variants = {}
+    for i, row in enumerate(rows):
+        name = str(row.pop('name', '') or f'variant-{i}')
+        if name in variants or os.path.basename(name) != name:
+            raise ValueError(f"Invalid or duplicated variant name {name!r} in {path}")
+        variants[name] = parse_params(row)
+    return variants
+
+
+# ================== SWEEP ==================
+
+
+def _build_shared_stage(params: CoreParams):
+    """Worker entry point: checkpoints the shared stage of the variants with the same stem"""
+    next(stage for stage in core_stages(params) if stage.name == shared_stage).result()
+
+
+def _build_variant(name: str, params: CoreParams, folder: str, export_formats: tuple[str, ...]) -> VariantResult:
+    """Worker entry point: builds and exports a variant, reporting (instead of raising) any failure"""
+    start = time.time()
+    try:
+        core = build_core(params)
+        files = []
+        for export_format in export_formats:
+            path = os.path.join(folder, f'{name}.{export_format}')
+            (export_stl if export_format == 'stl' else export_step)(core, path)
+            files.append(path)
+        return VariantResult(name, 'ok', time.time() - start, files)
+    except Exception as e:
+        logger.debug("Failed building variant %s:\n%s", name, traceback.format_exc())
+        return VariantResult(name, 'failed', time.time() - start, error=f'{type(e).__name__}: {e}')
+    finally:
+        profiling.flush()
+
+
+def sweep(variants: dict[str, CoreParams], folder: str, export_formats: tuple[str, ...] = ('stl',),
+          jobs: int = None) -> Iterator[VariantResult]:
+    """Build and export the variants in worker processes, yielding their results as soon as each one finishes.
+
+    Subparts are reused across variants through the stage cache: the stages shared by several variants (e.g. with
+    the same stem but different nut grids or fillets) are built once, before the variants that load them."""
+    if unknown := set(export_formats) - set(formats):
+        raise ValueError(f"Unknown export formats {', '.join(sorted(unknown))}, available: {', '.join(formats)}")
+    os.makedirs(folder, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        if cache_enabled:
+            keys = {name: next(s.key for s in core_stages(params) if s.name == shared_stage)
+                    for name, params in variants.items()}
+            counts = Counter(keys.values())
+            first_of_key = {keys[name]: params for name, params in reversed(variants.items())}
+            wait([pool.submit(_build_shared_stage, params) for key, params in first_of_key.items()
+                  if counts[key] > 1])  # Failures are reported by the variants themselves
+        futures = {pool.submit(_build_variant, name, params, folder, export_formats): name
+                   for name, params in variants.items()}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:  # The worker died (e.g. a crash in OCCT), not just the build
+                yield VariantResult(futures[future], 'failed', 0, error=f'{type(e).__name__}: {e}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and export variants of the core from a table of parameters")
+    parser.add_argument('table', help="CSV (with a header) or JSON file of CoreParams, with an optional name column")
+    parser.add_argument('-o', '--output', default=os.path.join(os.path.dirname(__file__), '..', 'export', 'sweep'),
+                        help="output folder, which also gets a report.csv")
+    parser.add_argument('-f', '--format', action='append', choices=formats,
+                        help="export format, may be repeated (default: stl)")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: CPU count)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    start = time.time()
+    variants = load_table(args.table)
+    failed = 0
+    os.makedirs(args.output, exist_ok=True)
+    with open(os.path.join(args.output, 'report.csv'), 'w', newline='') as report_file:
+        report = csv.writer(report_file)
+        report.writerow(['name', 'status', 'seconds', 'files', 'error'])
+        for result in sweep(variants, args.output, tuple(args.format or ['stl']), args.jobs):
+            report.writerow([result.name, result.status, f'{result.seconds:.2f}', ' '.join(result.files),
+                             result.error or ''])
+            report_file.flush()  # Stream the report, for long sweeps
+            if result.status == 'ok':
+                logger.info("Built %s in %.2f seconds", result.name, result.seconds)
+            else:
+                logger.error("Failed building %s: %s", result.name, result.error)
+                failed += 1
+    logger.info("Built %d/%d variants in %.2f seconds", len(variants) - failed, len(variants), time.time() - start)
+    sys.exit(0 if failed == 0 else 1)
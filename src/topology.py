@@ -0,0 +1,184 @@
+# Cached topology queries: the sub-shapes of a shape and the keys used to select them are computed at most once
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Union
+
+import build123d as bd
+
+# Shapes whose index is kept around, least recently used first
+max_indexes = 8
+
+_missing = object()
+
+
+class TopologyIndex:
+    """The sub-shapes of a shape, with their centers, axis projections, geometry types, areas and lengths computed
+    lazily and only once, however many selections use them.
+
+    Shapes are immutable: a modified shape is a different shape, with its own index."""
+
+    def __init__(self, shape: bd.Shape):
+        self.shape = shape
+        self._sub_shapes: dict[str, list[bd.Shape]] = {}
+        self._members: set[int] = set()  # Only keys of these (kept alive) sub-shapes can be cached by their id
+        self._keys: dict[Hashable, dict[int, Any]] = {}
+
+    def _list(self, kind: str) -> 'IndexedShapeList':
+        if kind not in self._sub_shapes:
+            self._sub_shapes[kind] = getattr(self.shape, kind)()
+            self._members.update(map(id, self._sub_shapes[kind]))
+        return IndexedShapeList(self._sub_shapes[kind], self)
+
+    def vertices(self) -> 'IndexedShapeList':
+        return self._list('vertices')
+
+    def edges(self) -> 'IndexedShapeList':
+        return self._list('edges')
+
+    def faces(self) -> 'IndexedShapeList':
+        return self._list('faces')
+
+    def solids(self) -> 'IndexedShapeList':
+        return self._list('solids')
+
+    def key(self, criterion: Hashable, obj: bd.Shape, compute: Callable[[bd.Shape], Any]) -> Any:
+        """The key of a sub-shape for the criterion, computed on first use"""
+        if id(obj) not in self._members:
+            return compute(obj)
+        keys = self._keys.setdefault(criterion, {})
+        value = keys.get(id(obj), _missing)
+        if value is _missing:
+            value = keys[id(obj)] = compute(obj)
+        return value
+
+    def center(self, obj: bd.Shape) -> bd.Vector:
+        return self.key('center', obj, lambda o: o.center())
+
+
+class IndexedShapeList(bd.ShapeList):
+    """A ShapeList of sub-shapes of an indexed shape, whose filters and groups reuse the keys of the index.
+
+    Selections give the same results as the plain ShapeList ones, and keep being indexed when chained."""
+
+    def __init__(self, iterable, topology_index: TopologyIndex):
+        super().__init__(iterable)
+        self.topology_index = topology_index
+
+    def filter_by(self, filter_by: Union[bd.Axis, bd.GeomType, Any], reverse: bool = False,
+                  tolerance: float = 1e-5) -> 'IndexedShapeList':
+        if isinstance(filter_by, bd.GeomType):
+            criterion = 'geom_type'
+
+            def matches(obj):
+                return self.topology_index.key(criterion, obj, lambda o: o.geom_type) == filter_by
+        elif isinstance(filter_by, bd.Axis):
+            criterion = ('parallel', filter_by.position.to_tuple(), filter_by.direction.to_tuple(), tolerance)
+
+            def matches(obj):
+                return self.topology_index.key(criterion, obj, lambda o: len(bd.ShapeList([o]).filter_by(
+                    filter_by, tolerance=tolerance)) == 1)
+        else:  # Planes and custom predicates are not indexed
+            return IndexedShapeList(super().filter_by(filter_by, reverse, tolerance), self.topology_index)
+        return IndexedShapeList((obj for obj in self if matches(obj) != reverse), self.topology_index)
+
+    def group_by(self, group_by: Union[bd.Axis, bd.SortBy, Any] = bd.Axis.Z, reverse: bool = False,
+                 tol_digits: int = 6) -> bd.GroupBy:
+        index = self.topology_index
+        if isinstance(group_by, bd.Axis):
+            axis_as_location = group_by.location.inverse()
+            criterion = ('axis', group_by.position.to_tuple(), group_by.direction.to_tuple(), tol_digits)
+
+            def compute(obj):
+                return round((axis_as_location * bd.Location(index.center(obj))).position.Z, tol_digits)
+        elif group_by in (bd.SortBy.LENGTH, bd.SortBy.AREA, bd.SortBy.RADIUS, bd.SortBy.VOLUME):
+            criterion = (group_by, tol_digits)
+            attribute = group_by.name.lower()
+
+            def compute(obj):
+                return round(getattr(obj, attribute), tol_digits)
+        elif group_by == bd.SortBy.DISTANCE:
+            criterion = (group_by, tol_digits)
+
+            def compute(obj):
+                return round(index.center(obj).length, tol_digits)
+        else:  # Edges, wires and custom keys are not indexed
+            groups = super().group_by(group_by, reverse, tol_digits)
+            groups.groups = [IndexedShapeList(group, index) for group in groups.groups]
+            return groups
+
+        groups = bd.GroupBy(lambda obj: index.key(criterion, obj, compute), self, reverse=reverse)
+        groups.groups = [IndexedShapeList(group, index) for group in groups.groups]
+        return groups
+
+    def __add__(self, other: bd.ShapeList) -> 'IndexedShapeList':
+        return IndexedShapeList(super().__add__(other), self.topology_index)
+
+    def __sub__(self, other: bd.ShapeList) -> 'IndexedShapeList':
+        return IndexedShapeList(super().__sub__(other), self.topology_index)
+
+    def __and__(self, other: bd.ShapeList) -> 'IndexedShapeList':
+        return IndexedShapeList(super().__and__(other), self.topology_index)
+
+
+_indexes: OrderedDict[int, TopologyIndex] = OrderedDict()
+
+
+def topology_index(shape: bd.Shape) -> TopologyIndex:
+    """The query index of the shape, reused while the (same) shape is queried again"""
+    key = hash(shape)
+    index = _indexes.get(key)
+    if index is None or not index.shape.wrapped.IsEqual(shape.wrapped):
+        index = _indexes[key] = TopologyIndex(shape)
+    _indexes.move_to_end(key)
+    while len(_indexes) > max_indexes:
+        _indexes.popitem(last=False)
+    return index
+
+
+def _outcome(select: Callable[[], Union[bd.ShapeList, bd.GroupBy]]) -> Any:
+    """The ids of the selected sub-shapes (per group), or the type of the error of the selection"""
+    try:
+        result = select()
+    except Exception as e:
+        return type(e).__name__
+    if isinstance(result, bd.GroupBy):
+        return [[id(obj) for obj in group] for group in result]
+    return [id(obj) for obj in result]
+
+
+def check_equivalence(shape: bd.Shape) -> list[str]:
+    """The selections of the shape for which the indexed lists differ from the plain ShapeList ones"""
+    index = TopologyIndex(shape)
+    mismatches = []
+    for kind in ('vertices', 'edges', 'faces', 'solids'):
+        indexed = getattr(index, kind)()
+        plain = bd.ShapeList(indexed)  # The same sub-shapes, so they compare by id
+        axes = [bd.Axis.X, bd.Axis.Y, bd.Axis.Z]
+        selections = [('filter_by', criterion) for criterion in [*axes, *bd.GeomType]]
+        selections += [('group_by', criterion) for criterion in [*axes, *bd.SortBy]]
+        for method, criterion in selections:
+            for reverse in (False, True):
+                expected = _outcome(lambda: getattr(plain, method)(criterion, reverse=reverse))
+                # Twice, as the second selection reuses the keys computed by the first one
+                for attempt in ('first', 'cached'):
+                    if _outcome(lambda: getattr(indexed, method)(criterion, reverse=reverse)) != expected:
+                        mismatches.append(f"{kind}.{method}({criterion}, reverse={reverse}) ({attempt})")
+    return mismatches
+
+
+if __name__ == "__main__":
+    import logging
+    import sys
+
+    from src.core import build_core
+    from src.module_allen_box import build_lid
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('build123d').setLevel(logging.WARNING)
+    failed = False
+    for name, build in [('core', build_core), ('lid', build_lid)]:
+        mismatches = check_equivalence(build())
+        for mismatch in mismatches:
+            logging.error("Indexed selection of the %s differs from ShapeList: %s", name, mismatch)
+        logging.info("Checked the indexed selections of the %s: %d mismatches", name, len(mismatches))
+        failed = failed or bool(mismatches)
+    sys.exit(1 if failed else 0)
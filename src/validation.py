@@ -0,0 +1,81 @@
+# Validity checks of built shapes as named checkpoints, run according to the configured validation level
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional, TypeVar
+
+import build123d as bd
+
+from src.global_params import is_draft
+from src.profiling import stage
+
+logger = logging.getLogger(__name__)
+
+# Validation levels, from cheapest to most thorough: checkpoints of a level run if the configured level is at least as
+# thorough. 'final' only checks finished parts, 'stage' also checks the output of each build stage, and 'paranoid'
+# also checks after each risky step inside stages. Draft builds are never validated.
+levels = ('off', 'final', 'stage', 'paranoid')
+level = os.getenv('BUILD_VALIDATE', 'final')
+
+T = TypeVar('T', bound=bd.Shape)
+
+
+class ValidationError(ValueError):
+    pass
+
+
+@dataclass
+class Checkpoint:
+    name: str
+    level: str
+    seconds: float
+    error: Optional[str] = None  # None if the shape passed the checks
+
+
+checkpoints: list[Checkpoint] = []  # Run by this process, in order
+
+
+def set_level(new_level: str):
+    """Select the validation level for this process and the build processes it starts"""
+    global level
+    if new_level not in levels:
+        raise ValueError(f"Unknown validation level {new_level!r}, available: {', '.join(levels)}")
+    level = os.environ['BUILD_VALIDATE'] = new_level
+
+
+def enabled(checkpoint_level: str) -> bool:
+    return not is_draft() and levels.index(level) >= levels.index(checkpoint_level)
+
+
+def _check(shape: Optional[bd.Shape], solids: Optional[int]) -> Optional[str]:
+    if shape is None or shape.wrapped is None or shape.wrapped.IsNull():
+        return "empty shape"
+    if not shape.is_valid():
+        return "invalid BRep"
+    if solids is not None and len(shape.solids()) != solids:
+        return f"{len(shape.solids())} solids instead of {solids}"
+    return None
+
+
+def checkpoint(name: str, shape: T, level: str = 'stage', solids: Optional[int] = None) -> T:
+    """Check that the shape is valid (and has the expected number of solids) after the named step, if enabled by
+    the validation level. Raises a ValidationError naming the step that broke the shape."""
+    if level not in levels[1:]:
+        raise ValueError(f"Unknown checkpoint level {level!r}, available: {', '.join(levels[1:])}")
+    if not enabled(level):
+        return shape
+    start = time.time()
+    with stage(f'validate_{name}'):
+        error = _check(shape, solids)
+    checkpoints.append(Checkpoint(name, level, time.time() - start, error))
+    if error is not None:
+        last_valid = next((c.name for c in reversed(checkpoints) if c.error is None), 'none')
+        hint = '' if enabled('paranoid') else ', a more thorough validation level narrows down the step'
+        raise ValidationError(f"{name} broke the shape: {error} (last valid checkpoint: {last_valid}{hint})")
+    logger.debug("Checkpoint %s passed in %.3f seconds", name, checkpoints[-1].seconds)
+    return shape
+
+
+if level not in levels:
+    raise ValueError(f"Unknown validation level {level!r} in BUILD_VALIDATE, available: {', '.join(levels)}")
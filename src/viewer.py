@@ -0,0 +1,56 @@
+# Optional viewer integration: yacv is only imported (and its server started) when something is shown or exported.
+# In headless mode (BUILD_HEADLESS), nothing is shown and the viewer is never imported, for batch builds.
+import logging
+import os
+import sys
+from functools import cache
+
+from src.global_params import viewer_options
+
+logger = logging.getLogger(__name__)
+
+headless = os.getenv('BUILD_HEADLESS', '') != ''
+
+
+def set_headless(enabled: bool = True):
+    """Disable the viewer for this process and the build processes it starts"""
+    global headless
+    headless = enabled
+    if enabled:
+        os.environ['BUILD_HEADLESS'] = '1'
+    else:
+        os.environ.pop('BUILD_HEADLESS', None)
+
+
+@cache
+def _yacv():
+    if headless:
+        raise RuntimeError("The viewer is disabled in headless mode (BUILD_HEADLESS)")
+    import yacv_server  # Starts the server, unless YACV_DISABLE_SERVER is set
+    return yacv_server
+
+
+def show(*objects, names=None, **kwargs):
+    """Push the objects to the viewer, tessellated coarsely in draft mode (unless given other tolerances)"""
+    if headless:
+        return
+    _yacv().show(*objects, names=names, **{**viewer_options(), **kwargs})
+
+
+def show_all(**kwargs):
+    """Push every CAD object in the caller's variables to the viewer, named after them"""
+    if headless:
+        return
+    _yacv()
+    from yacv_server.cad import get_shape
+    variables = sys._getframe(1).f_locals  # Instead of yacv's search of the whole stack, which includes this frame
+    objects = {name: value for name, value in variables.items() if get_shape(value, error=False) is not None}
+    show(*objects.values(), names=list(objects), **kwargs)
+
+
+def export_all(folder: str, export_filter=lambda name, obj: True):
+    """Export the shown objects to GLB files in the folder, as loaded by the viewer"""
+    if headless:
+        logger.warning("Not exporting GLBs to %s in headless mode", folder)
+        return
+    _yacv().export_all(folder, export_filter=export_filter)
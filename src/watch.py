@@ -0,0 +1,125 @@
+# Keep the viewer up to date while editing: `python -m src.watch [target ...]`
+# Imports and cached parts stay warm in this process: on each change of src/, only the changed modules (and the
+# modules that use them) are reloaded, and only the targets whose geometry changed are pushed to the viewer again.
+import argparse
+import glob
+import importlib
+import logging
+import os
+import sys
+import time
+
+import build123d as bd
+
+from src import cache, viewer
+from src.global_params import set_build_mode, viewer_options
+from src.manifest import fingerprint, signature
+
+logger = logging.getLogger(__name__)
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def snapshot() -> dict[str, float]:
+    """Modification time of each source file"""
+    mtimes = {}
+    for path in glob.glob(os.path.join(src_dir, '*.py')):
+        try:
+            mtimes[path] = os.stat(path).st_mtime
+        except FileNotFoundError:  # Replaced while saving
+            pass
+    return mtimes
+
+
+def dependents(module_names: set[str]) -> list[str]:
+    """The loaded modules that (transitively) use the given ones, including them, dependencies first"""
+    loaded = [name for name in sys.modules if name.startswith('src.') and name != __name__]
+    deps = {name: cache.module_dependencies(name) for name in loaded}
+    affected = set(module_names) & set(loaded)
+    while new := {name for name in loaded if name not in affected and deps[name] & affected}:
+        affected |= new
+    ordered, visited = [], set()
+
+    def visit(name: str):
+        if name not in visited:  # Also against import cycles
+            visited.add(name)
+            for dep in sorted(deps[name] & affected):
+                visit(dep)
+            ordered.append(name)
+
+    for name in sorted(affected):
+        visit(name)
+    return ordered
+
+
+def reload(module_names: set[str]):
+    for name in dependents(module_names):
+        logger.info("Reloading %s", name)
+        importlib.reload(sys.modules[name])
+    cache.clear_digests()  # Changed sources change the keys of their cached parts
+
+
+def build_targets(names: list[str]) -> dict[str, bd.Shape]:
+    """Build the targets in this (warm) process, skipping the failed ones and their dependents"""
+    build = importlib.import_module('src.build')  # Which may have been reloaded
+    built = {}
+    for name in build.resolve(names):
+        target = build.targets[name]
+        if all(dep in built for dep in target.deps):
+            try:
+                built[name] = target.build(**{dep: built[dep] for dep in target.deps})
+            except Exception:
+                logger.exception("Failed building %s", name)
+    return built
+
+
+def watch(names: list[str], interval: float = 0.5):
+    shown: dict[str, str] = {}  # Fingerprints of the shown targets
+    mtimes = {}  # Of the sources that were last loaded successfully
+    failed_mtimes = None  # Of the sources that last failed to load, to wait for the next save
+    while True:
+        current = snapshot()
+        if current != mtimes and current != failed_mtimes:
+            changed = {f'src.{os.path.splitext(os.path.basename(path))[0]}'
+                       for path in set(current) | set(mtimes) if current.get(path) != mtimes.get(path)}
+            if mtimes:
+                if 'src.watch' in changed:
+                    logger.warning("The watcher itself changed, restart it to use the changes")
+                try:
+                    reload(changed)
+                except Exception:  # E.g. a half-typed edit: keep the old mtimes, so that the next save reloads again
+                    logger.exception("Failed reloading %s, waiting for the next change", ', '.join(sorted(changed)))
+                    failed_mtimes = current
+                    continue
+            mtimes, failed_mtimes = current, None
+            start = time.time()
+            for name, shape in build_targets(names).items():
+                shape_fingerprint = fingerprint(viewer_options(), signature(shape))
+                if shown.get(name) != shape_fingerprint:
+                    viewer.show(shape, names=[name], auto_clear=False)
+                    shown[name] = shape_fingerprint
+                    logger.info("Showing the new %s", name)
+            logger.info("Up to date in %.2f seconds, watching %s for changes", time.time() - start, src_dir)
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    from src.build import targets
+
+    parser = argparse.ArgumentParser(description="Rebuild and show targets whenever their source changes")
+    parser.add_argument('targets', nargs='*', help=f"targets to show (default: all exported ones): "
+                                                   f"{', '.join(targets)}")
+    parser.add_argument('--interval', type=float, default=0.5, help="seconds between checks for changes")
+    parser.add_argument('--draft', action='store_true',
+                        help="fast preview build, without cosmetic fillets/chamfers (not for printing)")
+    args = parser.parse_args()
+    if unknown := set(args.targets) - set(targets):
+        parser.error(f"unknown targets: {', '.join(sorted(unknown))}")
+    if args.draft:
+        set_build_mode('draft')
+    if viewer.headless:
+        parser.error("there is nothing to watch in headless mode (BUILD_HEADLESS)")
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('build123d').setLevel(logging.WARNING)  # Too verbose for every rebuild
+    watch(args.targets or [name for name, t in targets.items() if t.export], args.interval)